@@ -13,6 +13,26 @@ import statsmodels.api as sm
 import warnings
 
 
+# Every random draw of the tests starts from a seeded stream, so the results do not depend on the batch or worker a gene runs in. 
+# The seeds are mixed into their entropy pools once here instead of on every call.
+_boot_seed = np.random.SeedSequence(5) # bootstrap resampling
+_fill_seed = np.random.SeedSequence(6) # replacement of invalid replicates
+_rep_seed = np.random.SeedSequence(7) # resampling of the replicates
+_code_seed = np.random.SeedSequence(8) # random projection of _unique_expr
+
+
+def _group_seed(group_idx, seed=_boot_seed):
+	"""
+		The stream of the group at :group_idx:, an independent child of :seed:.
+		
+		Groups must not share a stream: groups with similar unique values would otherwise draw nearly identical replicates, 
+		which shrinks the bootstrap standard errors of the differences between them. Every gene or pair of a group reuses 
+		the same stream, so the results do not depend on how they are batched.
+	"""
+	
+	return np.random.SeedSequence(seed.entropy, spawn_key=(group_idx,))
+
+
 def numpy_fill(arr):
 	nan_idxs = np.isnan(arr)
 	arr[nan_idxs] = np.nanmedian(arr)
@@ -37,6 +57,26 @@ def _convert_params(mu, alpha):
     return r, p
 	
 
+def _dense_rows(expr, rows):
+	"""
+		Returns the rows :rows: of the sparse matrix :expr: as a dense array, read straight from its CSC indices and data.
+	"""
+	
+	expr = expr.tocsc()
+	
+	position = np.full(expr.shape[0], -1)
+	position[rows] = np.arange(rows.shape[0])
+	
+	col = np.repeat(np.arange(expr.shape[1]), np.diff(expr.indptr))
+	row_position = position[expr.indices]
+	selected = row_position >= 0
+	
+	dense = np.zeros((rows.shape[0], expr.shape[1]), dtype=expr.dtype)
+	dense[row_position[selected], col[selected]] = expr.data[selected]
+	
+	return dense
+
+
 def _unique_expr(expr, size_factor):
 	"""
 		Precompute the size factor to separate it from the bootstrap.
@@ -59,16 +99,178 @@ def _unique_expr(expr, size_factor):
 # 	expr = expr#[inliers]
 # 	size_factor = size_factor#[inliers]
 	
-	code = expr.dot(np.random.random(expr.shape[1]))
+	gen = np.random.Generator(np.random.PCG64(_code_seed))
+	code = expr.dot(gen.random(expr.shape[1]))
 	approx_sf = size_factor
 		
-	code += np.random.random()*approx_sf
+	code += gen.random()*approx_sf
 	
 	_, index, count = np.unique(code, return_index=True, return_counts=True)
     
-	expr_to_return = expr[index].toarray()
+	expr_to_return = _dense_rows(expr, index).astype(np.float64)
+	
+	inv_sf = 1/approx_sf[index].reshape(-1, 1)
+	
+	return inv_sf, inv_sf**2, expr_to_return, count
+
+
+def _sf_bins(size_factor):
+	"""
+		Finds the distinct (binned) size factors, the bin of each cell and the number of cells in each bin, to be shared by every gene of a group.
+		
+		The bins are stored in the smallest unsigned integer type that holds them, since they are sent to every worker.
+	"""
+	
+	sf_values, sf_code, sf_count = np.unique(size_factor, return_inverse=True, return_counts=True)
+	
+	return sf_values, sf_code.astype(np.min_scalar_type(sf_values.shape[0])), sf_count
+
+
+def _count_codes(code, num_codes):
+	"""
+		Same as np.unique(code, return_counts=True) for non-negative integer codes below :num_codes:.
+		
+		When the codes span a small range compared to their number, they are tallied with np.bincount instead of being sorted.
+	"""
+	
+	if num_codes > max(4*code.shape[0], 2**16):
+		return np.unique(code, return_counts=True)
+	
+	count = np.bincount(code, minlength=num_codes)
+	unique_code = np.flatnonzero(count)
+	
+	return unique_code, count[unique_code]
+
+
+def _unique_values(data):
+	"""
+		Same as np.unique(data, return_inverse=True).
+		
+		Non-negative integer values in a small range, such as UMI counts, are histogrammed with np.bincount instead of being sorted.
+	"""
+	
+	if data.size == 0 or not data.min() >= 0 or data.max() >= max(4*data.size, 2**16) or not np.array_equal(data, np.round(data)):
+		return np.unique(data, return_inverse=True)
+	
+	int_data = data.astype(np.int64)
+	values = np.flatnonzero(np.bincount(int_data))
+	position = np.zeros(values[-1]+1, dtype=np.intp)
+	position[values] = np.arange(values.shape[0])
+	
+	return values.astype(data.dtype), position[int_data]
+
+
+def _unique_rows(arr):
+	"""
+		Same as np.unique(arr, axis=0, return_counts=True).
+		
+		Rows of non-negative integers are packed into one int64 code each, which sorts in the same order, instead of sorting a void view.
+	"""
+	
+	if arr.shape[0] == 0 or (arr < 0).any() or not np.array_equal(arr, np.round(arr)):
+		return np.unique(arr, axis=0, return_counts=True)
+	
+	span = arr.max(axis=0).astype(np.int64) + 1
+	if np.prod(span.astype(np.float64)) >= 2**62:
+		return np.unique(arr, axis=0, return_counts=True)
+	
+	code = np.zeros(arr.shape[0], dtype=np.int64)
+	for col in range(arr.shape[1]):
+		code = code*span[col] + arr[:, col].astype(np.int64)
+	unique_code, count = _count_codes(code, int(np.prod(span)))
+	
+	keys = np.empty((unique_code.shape[0], arr.shape[1]), dtype=arr.dtype)
+	for col in reversed(range(arr.shape[1])):
+		unique_code, keys[:, col] = np.divmod(unique_code, span[col])
 	
-	return 1/approx_sf[index].reshape(-1, 1), 1/approx_sf[index].reshape(-1, 1)**2, expr_to_return, count
+	return keys, count
+
+
+def _unique_expr_binned(expr, sf_bins):
+	"""
+		Finds and counts the unique rows of values and size factor bin of :expr:, given the output of _sf_bins.
+		
+		Only the cells with a nonzero value are sorted. The cells that are zero in every column are counted by bin.
+	"""
+	
+	sf_values, sf_code, sf_count = sf_bins
+	num_sf = sf_values.shape[0]
+	
+	rows = np.unique(expr.tocsc().indices)
+	keys, count = _unique_rows(np.hstack([_dense_rows(expr, rows), sf_code[rows].reshape(-1, 1)]))
+	
+	zero_count = sf_count - np.bincount(sf_code[rows], minlength=num_sf)
+	zero_sf = np.flatnonzero(zero_count)
+	
+	inv_sf = 1/np.concatenate([sf_values[zero_sf], sf_values[keys[:, -1].astype(int)]]).reshape(-1, 1)
+	expr_to_return = np.vstack([np.zeros((zero_sf.shape[0], expr.shape[1])), keys[:, :-1]]).astype(np.float64)
+	
+	return inv_sf, inv_sf**2, expr_to_return, np.concatenate([zero_count[zero_sf], count])
+
+
+def _unique_expr_batch(expr, size_factor, sf_bins=None):
+	"""
+		Finds and counts the unique pairs of value and size factor in every column of :expr: at once.
+		
+		The size factor bins are shared by all columns, so they are found once (or passed in as :sf_bins:). Cells with zero expression are counted by bin without being visited.
+		
+		:expr: is a CSC matrix. Returns a list with the output of _unique_expr for each column.
+	"""
+	
+	num_genes = expr.shape[1]
+	sf_values, sf_code, sf_count = _sf_bins(size_factor) if sf_bins is None else sf_bins
+	num_sf = sf_values.shape[0]
+	
+	# Count the nonzero cells by column, value, and size factor bin
+	col = np.repeat(np.arange(num_genes), np.diff(expr.indptr))
+	values, value_code = _unique_values(expr.data)
+	num_values = max(values.shape[0], 1)
+	key, key_count = _count_codes((col*num_values + value_code)*num_sf + sf_code[expr.indices], num_genes*num_values*num_sf)
+	key_col, key_value, key_sf = key//(num_values*num_sf), values[(key//num_sf)%num_values], key%num_sf
+	bounds = np.searchsorted(key_col, np.arange(num_genes+1))
+	
+	# Count the zero cells by column and size factor bin
+	zero_count = sf_count - \
+		np.bincount(col*num_sf + sf_code[expr.indices], minlength=num_genes*num_sf).reshape(num_genes, num_sf)
+	
+	results = []
+	for idx in range(num_genes):
+		
+		zero_sf = np.flatnonzero(zero_count[idx])
+		nonzero = slice(bounds[idx], bounds[idx+1])
+		
+		inv_sf = 1/np.concatenate([sf_values[zero_sf], sf_values[key_sf[nonzero]]]).reshape(-1, 1)
+		expr_to_return = np.concatenate([np.zeros(zero_sf.shape[0]), key_value[nonzero]]).reshape(-1, 1)
+		count = np.concatenate([zero_count[idx, zero_sf], key_count[nonzero]])
+		
+		results.append((inv_sf, inv_sf**2, expr_to_return, count))
+	
+	return results
+
+
+def _resample_expressed(gen, n_obs, inv_sf, inv_sf_sq, expr, counts, num_boot):
+	"""
+		Draws the bootstrap counts of the unique values of :expr:.
+		
+		Values that are zero in every column do not contribute to any moment, so they are drawn as a single merged category. 
+		This leaves the joint distribution of the other counts unchanged while skipping one binomial draw per size factor bin.
+		
+		Returns the expressed rows of :inv_sf:, :inv_sf_sq: and :expr: followed by one zero row for the merged category, and the (num_rows, num_boot) counts.
+		The merged row takes the count-weighted average size factor of the rows it stands for, so the counts still sum to :n_obs:.
+		The counts are cast to float once here, rather than in every estimator product that uses them.
+	"""
+	
+	expressed = (expr != 0).any(axis=1)
+	zero_counts = counts[~expressed]
+	merged_counts = np.append(counts[expressed], zero_counts.sum())
+	gene_rvs = gen.multinomial(n_obs, merged_counts/merged_counts.sum(), size=num_boot)
+	
+	zero_weight = zero_counts/max(zero_counts.sum(), 1)
+	inv_sf = np.vstack([inv_sf[expressed], zero_weight.dot(inv_sf[~expressed])])
+	inv_sf_sq = np.vstack([inv_sf_sq[expressed], zero_weight.dot(inv_sf_sq[~expressed])])
+	expr = np.vstack([expr[expressed], np.zeros((1, expr.shape[1]))])
+	
+	return inv_sf, inv_sf_sq, expr, gene_rvs.astype(np.float64).T
 
 
 def _bootstrap_1d(
@@ -78,20 +280,21 @@ def _bootstrap_1d(
 	_estimator_1d,
 	num_boot=1000,
 	return_times=False,
-	precomputed=None):
+	precomputed=None,
+	seed=_boot_seed):
 	"""
 		Perform the bootstrap and CI calculation for mean and variance.
 		
 		This function performs bootstrap for a single gene. 
 		
-		This function expects :data: to be a single sparse column vector.
+		This function expects :data: to be a single sparse column vector. :seed: is the SeedSequence of the bootstrap stream, see _group_seed.
 	"""
-	start_time = time.time()
+	if return_times:
+		return _bootstrap_1d_timed(data, size_factor, q, _estimator_1d, num_boot, precomputed, seed)
 	
 	# Pre-compute size factor
 	# Pass the pre-computed values for permutation test
 	inv_sf, inv_sf_sq, expr, counts = _unique_expr(data, size_factor) if precomputed is None else precomputed
-	count_time = time.time()
 		
 	# Skip this gene if it has no expression
 	if expr.shape[0] <= 1:
@@ -99,8 +302,8 @@ def _bootstrap_1d(
 	
 	n_obs = data.shape[0]
 		
-	gen = np.random.Generator(np.random.PCG64(5))
-	gene_rvs = gen.multinomial(data.shape[0], counts/counts.sum(), size=num_boot).T
+	gen = np.random.Generator(np.random.PCG64(seed))
+	inv_sf, inv_sf_sq, expr, gene_rvs = _resample_expressed(gen, n_obs, inv_sf, inv_sf_sq, expr, counts, num_boot)
 		
 	# Estimate mean and variance
 	mean, var = _estimator_1d(
@@ -108,14 +311,25 @@ def _bootstrap_1d(
 		n_obs=n_obs,
 		q=q,
 		size_factor=(inv_sf, inv_sf_sq))
-	boot_time = time.time()
-	
-	if return_times:
-		return start_time, count_time, boot_time
 
 	return mean, var
 
 
+def _bootstrap_1d_timed(data, size_factor, q, _estimator_1d, num_boot, precomputed, seed=_boot_seed):
+	"""
+		Times the counting and resampling steps of the 1D bootstrap for a single gene.
+	"""
+	start_time = time.time()
+	
+	precomputed = _unique_expr(data, size_factor) if precomputed is None else precomputed
+	count_time = time.time()
+	
+	_bootstrap_1d(data, size_factor, q, _estimator_1d, num_boot=num_boot, precomputed=precomputed, seed=seed)
+	boot_time = time.time()
+	
+	return start_time, count_time, boot_time
+
+
 def _bootstrap_2d(
 	data, 
 	size_factor,
@@ -123,18 +337,21 @@ def _bootstrap_2d(
 	_estimator_1d,
 	_estimator_cov,
 	num_boot=1000,
-	precomputed=None):
+	precomputed=None,
+	seed=_boot_seed):
 	"""
 		Perform the bootstrap and CI calculation for covariance and correlation.
+		
+		:seed: is the SeedSequence of the bootstrap stream, see _group_seed.
 	"""
 	Nc = data.shape[0]
 
 	inv_sf, inv_sf_sq, expr, counts = _unique_expr(data, size_factor) if precomputed is None else precomputed
 	
 	# Generate the bootstrap samples
-	gen = np.random.Generator(np.random.PCG64(5))
+	gen = np.random.Generator(np.random.PCG64(seed))
 # 	gene_rvs = gen.poisson(counts, size=(num_boot, counts.shape[0])).T
-	gene_rvs = gen.multinomial(data.shape[0], counts/counts.sum(), size=num_boot).T
+	inv_sf, inv_sf_sq, expr, gene_rvs = _resample_expressed(gen, Nc, inv_sf, inv_sf_sq, expr, counts, num_boot)
 	n_obs = Nc
 	
 	# Estimate the covariance and variance
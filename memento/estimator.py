@@ -17,6 +17,13 @@ import pickle as pkl
 
 
 def _get_estimator_1d(estimator_type):
+	"""
+		Returns the 1D estimator for :estimator_type:, or the first element of a custom (est_1d, est_cov) tuple.
+		
+		In the bootstrap, custom estimators get the tuple form of :data:, one row per unique (value, size factor bin). 
+		Values that are zero in every column are merged into a single zero row, with the count-weighted average size factor of the rows it replaces.
+		The total counts, zero fractions and sums over the values are exact, while sums of the size factors over all cells are exact only in expectation.
+	"""
 	
 	if estimator_type == 'hyper_absolute':
 		return _hyper_1d_absolute
@@ -46,6 +53,23 @@ def _get_estimator_cov(estimator_type):
 		return estimator_type[1]
 	
 
+def _row_sums(X, weight=None):
+	"""
+		Sum each row of a CSR matrix directly from its nonzero values, optionally weighting each column by :weight:.
+	"""
+	
+	if not sparse.isspmatrix_csr(X):
+		return np.asarray((X if weight is None else X.multiply(weight)).sum(axis=1), dtype=np.float64).reshape(-1)
+	
+	values = X.data.astype(np.float64) if weight is None else X.data*weight[X.indices]
+	nonempty = np.diff(X.indptr) > 0
+	sums = np.zeros(X.shape[0])
+	if values.shape[0] > 0:
+		sums[nonempty] = np.add.reduceat(values, X.indptr[:-1][nonempty])
+	
+	return sums
+
+
 def _estimate_size_factor(data, estimator_type, shrinkage, mask=None, total=False):
 	"""Calculate the size factor
 	
@@ -62,21 +86,16 @@ def _estimate_size_factor(data, estimator_type, shrinkage, mask=None, total=Fals
 	X=data
 	
 	if total:
-		Nrc = np.array(X.sum(axis=1)).reshape(-1)
-		Nr = Nrc.mean()
-		n_umi = np.array(X.sum(axis=1)).reshape(-1).mean()
+		Nrc = _row_sums(X)
 
 		size_factor = Nrc
 		
 	if mask is not None:
 	
-		Nrc = X.multiply(mask).sum(axis=1).A1
+		Nrc = _row_sums(X, mask.astype(np.float64))
 		Nrc += np.quantile(Nrc, shrinkage) # Shrinkage
 		Nr = Nrc.mean()
 		size_factor = Nrc/Nr
-		
-		n_umi = np.array(X.sum(axis=1)).reshape(-1).mean()
-		size_factor
 
 	return size_factor
 
@@ -100,15 +119,69 @@ def _fit_mv_regressor(mean, var):
 # 	return slope, inter
 
 
-def _residual_variance(mean, var, mv_fit):
+def _log_residual_variance(mean, var, mv_fit):
 	
 	cond = (mean > 0) & (var > 0)
-	rv = np.zeros(mean.shape)*np.nan
+	log_rv = np.full(mean.shape, np.nan)
 	
-	f = np.poly1d(mv_fit)
 	with np.errstate(invalid='ignore'):
-		rv[cond] = np.exp(np.log(var[cond]) - f(np.log(mean[cond])))
-	return rv
+		log_rv[cond] = np.log(var[cond]) - np.polyval(mv_fit, np.log(mean[cond]))
+	return log_rv
+
+
+def _residual_variance(mean, var, mv_fit):
+	
+	return np.exp(_log_residual_variance(mean, var, mv_fit))
+
+
+def _scale_rows(data, row_weight):
+	"""
+		Multiply each row of the sparse matrix :data: by :row_weight: by scaling its stored values directly.
+	"""
+	
+	data = data.tocsc()
+	
+	return sparse.csc_matrix((data.data*row_weight[data.indices], data.indices, data.indptr), shape=data.shape)
+
+
+def _weighted_column_sums(data, row_weight, q):
+	"""
+		Sums of the stored values of the sparse matrix :data: over each column, weighted by :row_weight:, and of their hypergeometric second moment.
+		
+		Works on the CSC buffers directly, so no squared copy of the matrix is made. :q: of 0 gives the Poisson second moment.
+	"""
+	
+	data = data.tocsc()
+	
+	col = np.repeat(np.arange(data.shape[1]), np.diff(data.indptr))
+	row_weight = row_weight[data.indices]
+	values = data.data.astype(np.float64)
+	
+	sum_1 = np.bincount(col, weights=row_weight*values, minlength=data.shape[1])
+	sum_2 = np.bincount(col, weights=row_weight**2*(values**2 - (1-q)*values), minlength=data.shape[1])
+	
+	return sum_1, sum_2
+
+
+def _pair_sums(data, row_weight, idx1, idx2):
+	"""
+		Weighted sums of the products of the gene pairs (idx1[i], idx2[i]), along with the weighted sums of each gene of the pair 
+		and the squared-weight sums of the first gene. 
+		
+		The single gene sums are computed once for each distinct gene rather than once for each pair.
+	"""
+	
+	# Multiply the pair columns once and apply both row weights in the same reduction
+	X = data[:, idx1]
+	XY = X.multiply(X) if np.array_equal(idx1, idx2) else X.multiply(data[:, idx2])
+	prod = XY.T.dot(row_weight**2)
+
+	genes, inverse = np.unique(np.concatenate([idx1, idx2]), return_inverse=True)
+	gene_data = data[:, genes].T
+	gene_sum = gene_data.dot(row_weight)
+	gene_sum_sq = gene_data.dot(row_weight**2)
+	
+	return prod, gene_sum[inverse[:len(idx1)]], gene_sum[inverse[len(idx1):]], gene_sum_sq[inverse[:len(idx1)]]
 
 
 def _poisson_1d_relative(data, n_obs, size_factor=None):
@@ -119,13 +192,13 @@ def _poisson_1d_relative(data, n_obs, size_factor=None):
 	"""
 	if type(data) == tuple:
 		size_factor = size_factor if size_factor is not None else (1, 1)
-		mm_M1 = (data[0]*data[1]*size_factor[0]).sum(axis=0)/n_obs
-		mm_M2 = (data[0]**2*data[1]*size_factor[1] - data[0]*data[1]*size_factor[1]).sum(axis=0)/n_obs
+		weights = np.hstack([data[0]*size_factor[0], (data[0]**2 - data[0])*size_factor[1]])
+		mm_M1, mm_M2 = weights.T.dot(data[1])/n_obs
 	else:
 		
-		row_weight = (1/size_factor).reshape([1, -1]) if size_factor is not None else np.ones(data.shape[0])
-		mm_M1 = sparse.csc_matrix.dot(row_weight, data).ravel()/n_obs
-		mm_M2 = sparse.csc_matrix.dot(row_weight**2, data.power(2)).ravel()/n_obs - sparse.csc_matrix.dot(row_weight**2, data).ravel()/n_obs
+		row_weight = 1/size_factor if size_factor is not None else np.ones(data.shape[0])
+		sum_1, sum_2 = _weighted_column_sums(data, row_weight, q=0)
+		mm_M1, mm_M2 = sum_1/n_obs, sum_2/n_obs
 	
 	mm_mean = mm_M1
 	mm_var = (mm_M2 - mm_M1**2)
@@ -141,23 +214,19 @@ def _poisson_cov_relative(data, n_obs, size_factor, idx1, idx2):
 	"""
 	
 	if type(data) == tuple:
-		obs_M1 = (data[0]*data[2]*size_factor[0]).sum(axis=0)/n_obs
-		obs_M2 = (data[1]*data[2]*size_factor[0]).sum(axis=0)/n_obs
-		obs_MX = (data[0]*data[1]*data[2]*size_factor[1]).sum(axis=0)/n_obs
+		weights = np.hstack([data[0]*size_factor[0], data[1]*size_factor[0], data[0]*data[1]*size_factor[1]])
+		obs_M1, obs_M2, obs_MX = weights.T.dot(data[2])/n_obs
 		cov = obs_MX - obs_M1*obs_M2
 
 	else:
 		
 		overlap_location = (idx1 == idx2)
-		overlap_idx = [i for i,j in zip(idx1, idx2) if i == j]
 		
-		row_weight = np.sqrt(1/(size_factor**2)).reshape([1, -1])
-		X, Y = data[:, idx1].T.multiply(row_weight).T.tocsr(), data[:, idx2].T.multiply(row_weight).T.tocsr()
+		prod, sum_1, sum_2, sum_sq_1 = _pair_sums(data, 1/size_factor, idx1, idx2)
 		
-		prod = X.multiply(Y).sum(axis=0).A1/n_obs
-		if len(overlap_idx) >0:
-			prod[overlap_location] = prod[overlap_location] - data[:, overlap_idx].T.multiply(row_weight**2).T.tocsr().sum(axis=0).A1/n_obs
-		cov = prod - X.mean(axis=0).A1*Y.mean(axis=0).A1
+		prod = prod/n_obs
+		prod[overlap_location] = prod[overlap_location] - sum_sq_1[overlap_location]/n_obs
+		cov = prod - (sum_1/data.shape[0])*(sum_2/data.shape[0])
 					
 	return cov
 
@@ -170,14 +239,12 @@ def _hyper_1d_relative(data, n_obs, q, size_factor=None):
 	"""
 	if type(data) == tuple:
 		size_factor = size_factor if size_factor is not None else (1, 1)
-		mm_M1 = (data[0]*data[1]*size_factor[0]).sum(axis=0)/n_obs
-		mm_M2 = (data[0]**2*data[1]*size_factor[1] - (1-q)*data[0]*data[1]*size_factor[1]).sum(axis=0)/n_obs
+		weights = np.hstack([data[0]*size_factor[0], (data[0]**2 - (1-q)*data[0])*size_factor[1]])
+		mm_M1, mm_M2 = weights.T.dot(data[1])/n_obs
 	else:
 		
-		row_weight = (1/size_factor).reshape([1, -1])
-		row_weight_sq = (1/size_factor**2).reshape([1, -1])
-		mm_M1 = sparse.csc_matrix.dot(row_weight, data).ravel()/n_obs
-		mm_M2 = sparse.csc_matrix.dot(row_weight_sq, data.power(2)).ravel()/n_obs - (1-q)*sparse.csc_matrix.dot(row_weight_sq, data).ravel()/n_obs
+		sum_1, sum_2 = _weighted_column_sums(data, 1/size_factor, q)
+		mm_M1, mm_M2 = sum_1/n_obs, sum_2/n_obs
 	
 	mm_mean = mm_M1
 	mm_var = (mm_M2 - mm_M1**2)
@@ -185,6 +252,32 @@ def _hyper_1d_relative(data, n_obs, q, size_factor=None):
 	return [mm_mean, mm_var]
 
 
+def _hyper_1d_relative_batched(data, group_codes, n_obs, q, size_factor):
+	"""
+		Estimate the mean and variance of every group at once using the hypergeometric noise process.
+		
+		:data: is a CSR matrix over all cells and :group_codes: assigns each of its rows to a group. 
+		:n_obs: and :q: have one entry per group, :size_factor: has one entry per cell.
+		Returns two (n_groups, n_genes) arrays, computed in a single pass over the nonzero entries.
+	"""
+	
+	num_groups, num_genes = n_obs.shape[0], data.shape[1]
+	
+	row_idx = np.repeat(np.arange(data.shape[0]), np.diff(data.indptr))
+	row_code = group_codes[row_idx].astype(np.int64)
+	row_weight = (1/size_factor)[row_idx]
+	values = data.data.astype(np.float64)
+	bin_idx = row_code*num_genes + data.indices
+	
+	mm_M1 = np.bincount(bin_idx, weights=row_weight*values, minlength=num_groups*num_genes).reshape(num_groups, num_genes)/n_obs.reshape(-1, 1)
+	mm_M2 = np.bincount(bin_idx, weights=row_weight**2*(values**2 - (1-q[row_code])*values), minlength=num_groups*num_genes).reshape(num_groups, num_genes)/n_obs.reshape(-1, 1)
+	
+	mm_mean = mm_M1
+	mm_var = (mm_M2 - mm_M1**2)
+	
+	return [mm_mean, mm_var]
+
+
 def _mean_only_1p(data, n_obs, q, size_factor=None):
 	"""
 		Estimate the variance using the Poisson noise process.
@@ -193,7 +286,7 @@ def _mean_only_1p(data, n_obs, q, size_factor=None):
 	"""
 	if type(data) == tuple:
 		size_factor = size_factor if size_factor is not None else (1, 1)
-		mm_M1 = (data[0]*data[1]*size_factor[0]).sum(axis=0)/n_obs
+		mm_M1 = (data[0]*size_factor[0]).T.dot(data[1]).ravel()/n_obs
 	else:
 		
 		row_weight = (1/size_factor).reshape([1, -1])
@@ -201,7 +294,7 @@ def _mean_only_1p(data, n_obs, q, size_factor=None):
 	
 	mm_mean = mm_M1
 
-	return [mm_mean+1, np.ones(mm_mean.shape)*10]
+	return [mm_mean+1, np.full(mm_mean.shape, 10.0)]
 
 
 def _hyper_cov_relative(data, n_obs, size_factor, q, idx1=None, idx2=None):
@@ -212,23 +305,19 @@ def _hyper_cov_relative(data, n_obs, size_factor, q, idx1=None, idx2=None):
 	"""
 	
 	if type(data) == tuple:
-		obs_M1 = (data[0]*data[2]*size_factor[0]).sum(axis=0)/n_obs
-		obs_M2 = (data[1]*data[2]*size_factor[0]).sum(axis=0)/n_obs
-		obs_MX = (data[0]*data[1]*data[2]*size_factor[1]).sum(axis=0)/n_obs
+		weights = np.hstack([data[0]*size_factor[0], data[1]*size_factor[0], data[0]*data[1]*size_factor[1]])
+		obs_M1, obs_M2, obs_MX = weights.T.dot(data[2])/n_obs
 		cov = obs_MX - obs_M1*obs_M2
 
 	else:
 
 		overlap_location = (idx1 == idx2)
-		overlap_idx = [i for i,j in zip(idx1, idx2) if i == j]
 		
-		row_weight = np.sqrt(1/size_factor**2).reshape([1, -1])
-		X, Y = data[:, idx1].T.multiply(row_weight).T.tocsr(), data[:, idx2].T.multiply(row_weight).T.tocsr()
+		prod, sum_1, sum_2, sum_sq_1 = _pair_sums(data, 1/size_factor, idx1, idx2)
 		
-		prod = X.multiply(Y).sum(axis=0).A1/n_obs
-		if len(overlap_idx) >0:
-			prod[overlap_location] = prod[overlap_location] - (1-q)*data[:, overlap_idx].T.multiply(row_weight**2).T.tocsr().sum(axis=0).A1/n_obs
-		cov = prod - X.mean(axis=0).A1*Y.mean(axis=0).A1
+		prod = prod/n_obs
+		prod[overlap_location] = prod[overlap_location] - (1-q)*sum_sq_1[overlap_location]/n_obs
+		cov = prod - (sum_1/data.shape[0])*(sum_2/data.shape[0])
 					
 	return cov
 
@@ -237,23 +326,23 @@ def _hyper_corr_symmetric(data, n_obs, size_factor, q, var, idx1=None, idx2=None
 	"""
 		Estimate the correlation matrix given a dataset.
 		This function is useful for computing an all by all correlation matrix for clustering, input to other algorithms.
+		
+		If :idx1: and :idx2: are given, only the (len(idx1), len(idx2)) block between those genes is computed.
 	"""
 
-	idx1 = np.arange(0, data.shape[1])
-	idx2 = np.arange(0, data.shape[1])
+	idx1 = np.arange(0, data.shape[1]) if idx1 is None else np.asarray(idx1)
+	idx2 = np.arange(0, data.shape[1]) if idx2 is None else np.asarray(idx2)
 
-	overlap = set(idx1) & set(idx2)
+	# Positions in the block where a gene meets itself
+	position_2 = np.full(data.shape[1], -1)
+	position_2[idx2] = np.arange(idx2.shape[0])
+	overlap_idx1 = np.flatnonzero(position_2[idx1] >= 0)
+	overlap_idx2 = position_2[idx1[overlap_idx1]]
 
-	overlap_idx1 = [i for i in idx1 if i in overlap]
-	overlap_idx2 = [i for i in idx2 if i in overlap]
-
-	overlap_idx1 = [new_i for new_i,i in enumerate(idx1) if i in overlap]
-	overlap_idx2 = [new_i for new_i,i in enumerate(idx2) if i in overlap]
-
-	row_weight = np.sqrt(1/(size_factor**2)).reshape([1, -1])
-	X, Y = data[:, idx1].T.multiply(row_weight).T.tocsr(), data[:, idx2].T.multiply(row_weight).T.tocsr()
+	row_weight = 1/size_factor
+	X, Y = _scale_rows(data[:, idx1], row_weight), _scale_rows(data[:, idx2], row_weight)
 	prod = (X.T*Y).toarray()/X.shape[0]
-	prod[overlap_idx1, overlap_idx2] = prod[overlap_idx1, overlap_idx2] - (1-q)*data[:, overlap_idx1].T.multiply(row_weight**2).T.tocsr().sum(axis=0).A1/n_obs
+	prod[overlap_idx1, overlap_idx2] = prod[overlap_idx1, overlap_idx2] - (1-q)*data[:, idx1[overlap_idx1]].T.dot(row_weight**2)/n_obs
 	cov = prod - np.outer(X.mean(axis=0).A1, Y.mean(axis=0).A1)
 	
 	var_1 = var[idx1]
@@ -278,15 +367,10 @@ def _corr_from_cov(cov, var_1, var_2, boot=False):
 	if type(cov) != np.ndarray:
 		return cov/np.sqrt(var_1*var_2)
 		
-	corr = np.full(cov.shape, 5.0)
-	
 	var_1[var_1 <= 0] = np.nan
 	var_2[var_2 <= 0] = np.nan
 	var_prod = np.sqrt(var_1*var_2)
-		
-	corr[np.isfinite(var_prod)] = cov[np.isfinite(var_prod)] / var_prod[np.isfinite(var_prod)]
 	
-	corr[corr > 1] = 1
-	corr[corr < -1] = -1
+	corr = np.divide(cov, var_prod, out=np.full(cov.shape, 5.0), where=np.isfinite(var_prod))
 	
-	return corr
+	return np.clip(corr, -1, 1, out=corr)
@@ -6,8 +6,8 @@
 
 import numpy as np
 import scipy.stats as stats
+import scipy.special as special
 import scipy.sparse as sparse
-from sklearn.linear_model import LinearRegression
 import warnings
 
 import memento.bootstrap as bootstrap
@@ -15,27 +15,42 @@ import memento.estimator as estimator
 
 def _robust_log(val):
 	
-	val[np.less_equal(val, 0., where=~np.isnan(val))] = np.nanmean(val)
+	val[val <= 0] = np.nanmean(val) # False for nan
 	
 	return np.log(val)
 
 
-def _fill(val):
+def _fill(val, gen):
 	
-	condition = np.less_equal(val, 0., where=~np.isnan(val)) | np.isnan(val)
-	num_invalid = condition.sum()
+	condition = ~(val > 0) # True for nan as well as non-positive values
+	num_invalid = np.count_nonzero(condition)
 	
 	if num_invalid == val.shape[0]:
 		return None
 	
-	val[condition] = np.random.choice(val[~condition], num_invalid)
+	val[condition] = gen.choice(val[~condition], num_invalid)
 	
 	return val
 
-def _fill_corr(val):
+def _fill_log(log_val, gen):
+	"""
+		Same as _fill, for values that are already in log space.
+	"""
+	
+	condition = ~np.isfinite(log_val)
+	num_invalid = np.count_nonzero(condition)
+	
+	if num_invalid == log_val.shape[0]:
+		return None
+	
+	log_val[condition] = gen.choice(log_val[~condition], num_invalid)
+	
+	return log_val
+
+def _fill_corr(val, gen):
 	
 	condition = np.isnan(val)
-	val[condition] = np.random.choice(val[~condition], condition.sum())
+	val[condition] = gen.choice(val[~condition], np.count_nonzero(condition))
 	
 	return val
 
@@ -47,13 +62,24 @@ def _push(val, cond='neg'):
 	else:
 		nan_idx = np.isnan(val)
 	
-	nan_count = nan_idx.sum()
+	nan_count = np.count_nonzero(nan_idx)
 	val[:(val.shape[0]-nan_count)] = val[~nan_idx]
 	val[(val.shape[0]-nan_count):] = np.nan
 	
 	return val
 
 
+def _normal_asl(stat, loc, scale):
+	"""
+		Two-sided tail probability of :stat: under a normal null with the given location and scale, written with ndtr to skip the scipy.stats dispatch.
+	"""
+	
+	abs_stat = np.abs(stat)
+	scale = np.where(scale > 0, scale, np.nan)
+	
+	return special.ndtr((loc - abs_stat)/scale) + special.ndtr((-abs_stat - loc)/scale)
+
+
 def _compute_asl(perm_diff, resampling, approx=False):
 	""" 
 		Use the generalized pareto distribution to model the tail of the permutation distribution. 
@@ -76,16 +102,12 @@ def _compute_asl(perm_diff, resampling, approx=False):
 	
 	if approx:
 		
-		null_params = stats.norm.fit(null)
-		
-		abs_stat = np.abs(stat)
-		
-		return stats.norm.sf(abs_stat, *null_params) + stats.norm.cdf(-abs_stat, *null_params)
+		return _normal_asl(stat, null.mean(), null.std())
 
 	if stat > 0:
-		extreme_count = (null > stat).sum() + (null < -stat).sum()
+		extreme_count = np.count_nonzero(null > stat) + np.count_nonzero(null < -stat)
 	else:
-		extreme_count = (null > -stat).sum() + (null < stat).sum()
+		extreme_count = np.count_nonzero(null > -stat) + np.count_nonzero(null < stat)
 
 	if extreme_count > 10: # We do not need to use the GDP approximation. 
 
@@ -96,20 +118,23 @@ def _compute_asl(perm_diff, resampling, approx=False):
 			warnings.simplefilter("ignore")
 			try:
 
-				perm_dist = np.sort(null)# if perm_mean < 0 else np.sort(-perm_diff) # For fitting the GDP later on
+				# Only the 300 most extreme values on each side are fit, so partition them out and sort just those
+				n_tail = min(300, null.shape[0])
+				left_dist = np.sort(np.partition(null, n_tail-1)[:n_tail])
+				right_dist = np.sort(np.partition(null, null.shape[0]-n_tail)[-n_tail:])
 
 				# Left tail
 				N_exec = 300
 				left_fit = False
 				while N_exec > 50:
 
-					tail_data = perm_dist[:N_exec]
+					tail_data = left_dist[:N_exec]
 					params = stats.genextreme.fit(tail_data)
 					_, ks_pval = stats.kstest(tail_data, 'genextreme', args=params)
 
 					if ks_pval > 0.05: # roughly a genpareto distribution
 						val = stats.genextreme.cdf(-np.abs(stat), *params)
-						left_asl = (N_exec/perm_dist.shape[0]) * val
+						left_asl = (N_exec/null.shape[0]) * val
 						left_fit = True
 						break
 					else: # Failed to fit genpareto
@@ -122,13 +147,13 @@ def _compute_asl(perm_diff, resampling, approx=False):
 				N_exec = 300
 				while N_exec > 50:
 
-					tail_data = perm_dist[-N_exec:]
+					tail_data = right_dist[-N_exec:]
 					params = stats.genextreme.fit(tail_data)
 					_, ks_pval = stats.kstest(tail_data, 'genextreme', args=params)
 
 					if ks_pval > 0.05: # roughly a genpareto distribution
 						val = stats.genextreme.sf(np.abs(stat), *params)
-						right_asl = (N_exec/perm_dist.shape[0]) * val
+						right_asl = (N_exec/null.shape[0]) * val
 						return right_asl + left_asl
 					else: # Failed to fit genpareto
 						N_exec -= 30					
@@ -139,27 +164,65 @@ def _compute_asl(perm_diff, resampling, approx=False):
 
 				# Failed to fit genpareto, return the upper bound
 				return (extreme_count+1) / (null.shape[0]+1)
+
+
+def _compute_asl_rows(coefs, resampling, approx=False):
+	"""
+		Applies _compute_asl to each row of coefs.
+
+		Rows with more than 10 extreme resamples, and all rows when :approx:, are handled for all rows at once; only the remaining rows go through the tail fit.
+	"""
+
+	stat = coefs[:, :1]
+	null = coefs[:, 1:] - stat if resampling == 'bootstrap' else coefs[:, 1:]
+	finite = np.isfinite(null)
+	abs_stat = np.abs(stat)
+
+	with np.errstate(invalid='ignore'):
+		constant = (coefs == coefs.mean(axis=1, keepdims=True)).all(axis=1)
+
+	if approx:
 		
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore")
+			null = np.where(finite, null, np.nan)
+			asl = _normal_asl(stat[:, 0], np.nanmean(null, axis=1), np.nanstd(null, axis=1))
+		asl[constant] = np.nan
 		
-def _ht_1d(
+		return asl
+
+	with np.errstate(invalid='ignore'):
+		extreme_count = np.count_nonzero(finite & ((null > abs_stat) | (null < -abs_stat)), axis=1)
+
+	asl = (extreme_count+1) / (np.count_nonzero(finite, axis=1)+1)
+	asl[constant] = np.nan
+	for idx in np.where(~constant & (extreme_count <= 10))[0]:
+		asl[idx] = _compute_asl(coefs[idx], resampling, approx)
+
+	return asl
+
+
+def _bootstrap_1d_groups(
 	true_mean, # list of means
 	true_res_var, # list of residual variances
 	cells, # list of sparse vectors/matrices
 	approx_sf, # list of dense arrays
-	covariate,
-	treatment,
-	Nc_list,
 	num_boot,
 	mv_fit, # list of tuples
 	q, # list of numbers
 	_estimator_1d,
-	**kwargs):
+	precomputed=None): # list of outputs of bootstrap._unique_expr
+	"""
+		Generates the bootstrap replicates of the log mean and log residual variance of a single gene in each group.
+		
+		The first column holds the observed values. Returns a mask of the groups with valid replicates as well.
+	"""
 	
-	good_idxs = np.zeros(treatment.shape[0], dtype=bool)
+	good_idxs = np.zeros(len(true_mean), dtype=bool)
 	
 	# the resampled arrays
-	boot_mean = np.zeros((treatment.shape[0], num_boot+1))*np.nan
-	boot_var = np.zeros((treatment.shape[0], num_boot+1))*np.nan
+	boot_mean = np.full((len(true_mean), num_boot+1), np.nan)
+	boot_var = np.full((len(true_mean), num_boot+1), np.nan)
 
 	for group_idx in range(len(true_mean)):
 
@@ -180,24 +243,55 @@ def _ht_1d(
 			num_boot=num_boot,
 			q=q[group_idx],
 			_estimator_1d=_estimator_1d,
-			precomputed=None)
+			precomputed=None if precomputed is None else precomputed[group_idx],
+			seed=bootstrap._group_seed(group_idx))
 		
-		# Compute the residual variance
-		res_var = estimator._residual_variance(mean, var, mv_fit[group_idx])
+		# Compute the log mean and log residual variance
+		with np.errstate(divide='ignore', invalid='ignore'):
+			log_mean = np.log(mean)
+		log_res_var = estimator._log_residual_variance(mean, var, mv_fit[group_idx])
 		
 		# Minimize invalid values
-		filled_mean = _fill(mean)#_push_nan(mean)#[:num_boot]
-		filled_var = _fill(res_var)#_push_nan(res_var)#[:num_boot]
+		fill_gen = np.random.Generator(np.random.PCG64(bootstrap._group_seed(group_idx, bootstrap._fill_seed)))
+		filled_mean = _fill_log(log_mean, fill_gen)
+		filled_var = _fill_log(log_res_var, fill_gen)
 		
 		# Make sure its a valid replicate
 		if filled_mean is None or filled_var is None:
 			continue
 		
-		boot_mean[group_idx, 1:] = np.log(filled_mean)
-		boot_var[group_idx, 1:] = np.log(filled_var)
+		boot_mean[group_idx, 1:] = filled_mean
+		boot_var[group_idx, 1:] = filled_var
 		
 		# This replicate is good
 		good_idxs[group_idx] = True
+	
+	return good_idxs, boot_mean, boot_var
+
+
+def _ht_1d(
+	true_mean, # list of means
+	true_res_var, # list of residual variances
+	cells, # list of sparse vectors/matrices
+	approx_sf, # list of dense arrays
+	covariate,
+	treatment,
+	Nc_list,
+	num_boot,
+	mv_fit, # list of tuples
+	q, # list of numbers
+	_estimator_1d,
+	**kwargs):
+	
+	good_idxs, boot_mean, boot_var = _bootstrap_1d_groups(
+		true_mean=true_mean,
+		true_res_var=true_res_var,
+		cells=cells,
+		approx_sf=approx_sf,
+		num_boot=num_boot,
+		mv_fit=mv_fit,
+		q=q,
+		_estimator_1d=_estimator_1d)
 		
 	# Skip this gene
 	if good_idxs.sum() == 0:
@@ -215,6 +309,93 @@ def _ht_1d(
 	return vals
 
 
+def _csc_column(mat, idx):
+	"""
+		Returns column :idx: of the CSC matrix :mat: as a one column CSC matrix that shares the buffers of :mat:.
+	"""
+	
+	start, end = mat.indptr[idx], mat.indptr[idx+1]
+	return sparse.csc_matrix((mat.data[start:end], mat.indices[start:end], np.array([0, end-start])), shape=(mat.shape[0], 1))
+
+
+def _ht_1d_batch(
+	true_mean, # (n_groups, n_genes) array of means for the genes in the batch
+	true_res_var, # (n_groups, n_genes) array of residual variances for the genes in the batch
+	cells, # list of sparse matrices with the genes in the batch as columns
+	approx_sf, # list of dense arrays
+	covariate,
+	treatment, # list of treatment arrays, one for each gene in the batch
+	Nc_list,
+	num_boot,
+	mv_fit, # list of tuples
+	q, # list of numbers
+	_estimator_1d,
+	sf_bins=None, # list of outputs of bootstrap._sf_bins
+	**kwargs):
+	"""
+		Performs hypothesis testing for a batch of genes, so that the arrays shared by all genes are sent to a worker once.
+		
+		Genes with the same valid groups and treatment are regressed together.
+	"""
+	
+	if kwargs.get('resample_rep', False): # The resampled replicates differ between genes
+		
+		return [_ht_1d(
+			true_mean=true_mean[:, idx],
+			true_res_var=true_res_var[:, idx],
+			cells=[_csc_column(c, idx) for c in cells],
+			approx_sf=approx_sf,
+			covariate=covariate,
+			treatment=treatment[idx],
+			Nc_list=Nc_list,
+			num_boot=num_boot,
+			mv_fit=mv_fit,
+			q=q,
+			_estimator_1d=_estimator_1d,
+			**kwargs) for idx in range(len(treatment))]
+	
+	# Find the unique values of all genes of a group at once
+	unique_expr = [bootstrap._unique_expr_batch(c, approx_sf[idx], None if sf_bins is None else sf_bins[idx]) for idx, c in enumerate(cells)]
+	
+	boots = [_bootstrap_1d_groups(
+		true_mean=true_mean[:, idx],
+		true_res_var=true_res_var[:, idx],
+		cells=[_csc_column(c, idx) for c in cells],
+		approx_sf=approx_sf,
+		num_boot=num_boot,
+		mv_fit=mv_fit,
+		q=q,
+		_estimator_1d=_estimator_1d,
+		precomputed=[u[idx] for u in unique_expr]) for idx in range(len(treatment))]
+	
+	# Group the genes that share a design
+	results = [(np.nan, np.nan, np.nan, np.nan, np.nan, np.nan)]*len(treatment)
+	designs = {}
+	for idx, (good_idxs, _, _) in enumerate(boots):
+		
+		# Skip this gene
+		if good_idxs.sum() == 0:
+			continue
+		
+		key = (good_idxs.tobytes(), treatment[idx].shape, treatment[idx].tobytes())
+		designs.setdefault(key, []).append(idx)
+	
+	for idxs in designs.values():
+		
+		good_idxs = boots[idxs[0]][0]
+		vals = _regress_1d_batch(
+			covariate=covariate[good_idxs, :],
+			treatment=treatment[idxs[0]][good_idxs, :],
+			boot_mean=np.stack([boots[idx][1][good_idxs, :] for idx in idxs], axis=-1),
+			boot_var=np.stack([boots[idx][2][good_idxs, :] for idx in idxs], axis=-1),
+			Nc_list=Nc_list[good_idxs],
+			**kwargs)
+		for idx, val in zip(idxs, vals):
+			results[idx] = val
+	
+	return results
+
+
 def _cross_coef(A, B, sample_weight):
 	
     # Rowwise mean of input arrays & subtract from input arrays themeselves
@@ -257,7 +438,7 @@ def _regress_1d(covariate, treatment, boot_mean, boot_var, Nc_list, resample_rep
 
 		print('skipped')
 
-		return [np.zeros(treatment.shape[1])*np.nan]*5
+		return [np.full(treatment.shape[1], np.nan)]*5
 	
 	if (treatment == 1).mean()==1:
 		
@@ -266,15 +447,17 @@ def _regress_1d(covariate, treatment, boot_mean, boot_var, Nc_list, resample_rep
 		
 	else:
 
-		boot_mean_tilde = boot_mean - LinearRegression(n_jobs=1).fit(covariate,boot_mean, Nc_list).predict(covariate)
-		boot_var_tilde = boot_var - LinearRegression(n_jobs=1).fit(covariate,boot_var, Nc_list).predict(covariate)
-		treatment_tilde = treatment - LinearRegression(n_jobs=1).fit(covariate, treatment, Nc_list).predict(covariate)
+		residual = _residual_operator(covariate, Nc_list)
+		boot_mean_tilde = residual.dot(boot_mean)
+		boot_var_tilde = residual.dot(boot_var)
+		treatment_tilde = _residual_treatment(residual, treatment, Nc_list)
 
 		if resample_rep:
 
-			replicate_assignment = np.random.choice(num_rep, size=(num_rep, num_boot))
+			gen = np.random.Generator(np.random.PCG64(bootstrap._rep_seed))
+			replicate_assignment = gen.choice(num_rep, size=(num_rep, num_boot))
 			replicate_assignment[:, 0] = np.arange(num_rep)
-			b_iter_assignment = np.random.choice(num_boot, (num_rep, num_boot))+1
+			b_iter_assignment = gen.choice(num_boot, (num_rep, num_boot))+1
 			b_iter_assignment[:, 0] = 0
 
 			boot_mean_resampled = boot_mean_tilde[(replicate_assignment, b_iter_assignment)]
@@ -291,8 +474,8 @@ def _regress_1d(covariate, treatment, boot_mean, boot_var, Nc_list, resample_rep
 			var_coef = _cross_coef(treatment_tilde, boot_var_tilde, Nc_list)
 
 
-	mean_asl = np.apply_along_axis(lambda x: _compute_asl(x, **kwargs), 1, mean_coef)
-	var_asl = np.apply_along_axis(lambda x: _compute_asl(x, **kwargs), 1, var_coef)
+	mean_asl = _compute_asl_rows(mean_coef, **kwargs)
+	var_asl = _compute_asl_rows(var_coef, **kwargs)
 
 	mean_se = np.nanstd(mean_coef[:, 1:], axis=1)
 	var_se = np.nanstd(var_coef[:, 1:], axis=1)
@@ -300,26 +483,130 @@ def _regress_1d(covariate, treatment, boot_mean, boot_var, Nc_list, resample_rep
 	return mean_coef[:, 0], mean_se, mean_asl, var_coef[:, 0], var_se, var_asl
 
 
-def _ht_2d(
+def _residual_operator(covariate, sample_weight):
+	"""
+		Returns the matrix that maps a response to its residual from a weighted least squares fit (with intercept) on :covariate:.
+	"""
+	
+	design = np.hstack([np.ones((covariate.shape[0], 1)), covariate])
+	sqrt_weight = np.sqrt(sample_weight).reshape(-1, 1)
+	
+	return np.eye(covariate.shape[0]) - design.dot(np.linalg.pinv(design*sqrt_weight))*sqrt_weight.T
+
+
+def _residual_treatment(residual, treatment, sample_weight):
+	"""
+		Returns the residuals of :treatment: after applying the :residual: operator.
+		
+		Columns that the covariates explain up to rounding are set to exactly zero, so that their coefficients come out as nan's.
+	"""
+	
+	treatment_tilde = residual.dot(treatment)
+	
+	# The pseudo-inverse leaves residues around 1e-16 where the columns are collinear with the covariates.
+	# These are measured against the uncentered second moment, which is nonzero even for a constant column.
+	ss = np.average(treatment_tilde**2, axis=0, weights=sample_weight)
+	scale = np.average(treatment**2, axis=0, weights=sample_weight)
+	treatment_tilde[:, ss <= np.finfo(np.float64).eps*treatment.shape[0]*scale] = 0
+	
+	return treatment_tilde
+
+
+def _coef_operator(covariate, treatment, sample_weight):
+	"""
+		Returns the matrix that maps a response to its weighted least squares coefficients on :treatment:, adjusting for :covariate:.
+		
+		This folds the residual operator and _cross_coef into one matrix, since the weighted residuals of the treatment have zero mean.
+	"""
+	
+	residual = _residual_operator(covariate, sample_weight)
+	
+	treatment_tilde = _residual_treatment(residual, treatment, sample_weight)
+	treatment_tilde = treatment_tilde - np.average(treatment_tilde, axis=0, weights=sample_weight)
+	ss = np.average(treatment_tilde**2, axis=0, weights=sample_weight)
+	
+	with np.errstate(invalid='ignore'):
+		return (treatment_tilde*sample_weight.reshape(-1, 1)).T.dot(residual)/sample_weight.sum()/ss.reshape(-1, 1)
+
+
+def _regress_1d_batch(covariate, treatment, boot_mean, boot_var, Nc_list, resample_rep=False, **kwargs):
+	"""
+		Performs hypothesis testing for many genes that share the same design, all at once.
+		
+		Here, :boot_mean: and :boot_var: have the genes stacked along the last axis. 
+		Returns the same values as calling _regress_1d on each gene without replicate resampling.
+	"""
+	
+	num_rep, num_col, num_genes = boot_mean.shape
+	
+	# Regress every bootstrap iteration of every gene at once, the iterations are dropped per gene afterwards
+	stacked_mean = boot_mean.reshape(num_rep, -1)
+	stacked_var = boot_var.reshape(num_rep, -1)
+	
+	if (treatment == 1).mean()==1:
+		
+		with np.errstate(invalid='ignore'):
+			mean_coef = np.average(stacked_mean, axis=0, weights=Nc_list).reshape(1, -1)
+			var_coef = np.average(stacked_var, axis=0, weights=Nc_list).reshape(1, -1)
+		
+	else:
+		
+		operator = _coef_operator(covariate, treatment, Nc_list)
+		mean_coef = operator.dot(stacked_mean)
+		var_coef = operator.dot(stacked_var)
+	
+	mean_coef = mean_coef.reshape(-1, num_col, num_genes)
+	var_coef = var_coef.reshape(-1, num_col, num_genes)
+	
+	# The bootstrap iterations that are finite in every group, for all genes at once
+	valid_iters = np.isfinite(boot_mean).all(axis=0) & np.isfinite(boot_var).all(axis=0)
+	
+	results = []
+	for idx in range(num_genes):
+		
+		valid_boostrap_iters = valid_iters[:, idx]
+		
+		if not valid_boostrap_iters.any():
+			
+			results.append(_regress_1d(covariate, treatment, boot_mean[:, :, idx], boot_var[:, :, idx], Nc_list, **kwargs))
+			continue
+		
+		gene_mean_coef = mean_coef[:, valid_boostrap_iters, idx]
+		gene_var_coef = var_coef[:, valid_boostrap_iters, idx]
+		
+		mean_asl = _compute_asl_rows(gene_mean_coef, **kwargs)
+		var_asl = _compute_asl_rows(gene_var_coef, **kwargs)
+
+		# Only iterations that are finite in every group are kept, so there are no nan's to skip
+		mean_se = np.std(gene_mean_coef[:, 1:], axis=1)
+		var_se = np.std(gene_var_coef[:, 1:], axis=1)
+		
+		results.append((gene_mean_coef[:, 0], mean_se, mean_asl, gene_var_coef[:, 0], var_se, var_asl))
+	
+	return results
+
+
+def _bootstrap_2d_groups(
 	true_corr, # list of correlations for each group
 	cells, # list of Nx2 sparse matrices
-	approx_sf,
-	covariate,
-	treatment,
-	Nc_list,
+	approx_sf, # list of dense arrays
 	num_boot,
-	q,
+	q, # list of numbers
 	_estimator_1d,
 	_estimator_cov,
-	**kwargs):
-	
+	sf_bins=None): # list of outputs of bootstrap._sf_bins
+	"""
+		Generates the bootstrap replicates of the correlation of a single pair of genes in each group.
 		
-	good_idxs = np.zeros(treatment.shape[0], dtype=bool)
+		The first column holds the observed values. Returns a mask of the groups with valid replicates as well.
+	"""
+	
+	good_idxs = np.zeros(len(true_corr), dtype=bool)
 	
 	# the bootstrap arrays
-	boot_corr = np.zeros((treatment.shape[0], num_boot+1))*np.nan
+	boot_corr = np.full((len(true_corr), num_boot+1), np.nan)
 	
-	for group_idx in range(treatment.shape[0]):
+	for group_idx in range(len(true_corr)):
 
 		# Skip if any of the 2d moments are NaNs
 		if np.isnan(true_corr[group_idx]) or (np.abs(true_corr[group_idx]) == 1):
@@ -336,12 +623,13 @@ def _ht_2d(
 			q=q[group_idx],
 			_estimator_1d=_estimator_1d,
 			_estimator_cov=_estimator_cov,
-			precomputed=None)
+			precomputed=None if sf_bins is None else bootstrap._unique_expr_binned(cells[group_idx], sf_bins[group_idx]),
+			seed=bootstrap._group_seed(group_idx))
 				
 		corr = estimator._corr_from_cov(cov, var_1, var_2, boot=True)
 			
 		# This replicate is good
-		vals = _fill_corr(corr)
+		vals = _fill_corr(corr, np.random.Generator(np.random.PCG64(bootstrap._group_seed(group_idx, bootstrap._fill_seed))))
 		
 		# Skip if all NaNs
 		if np.all(np.isnan(vals)):
@@ -349,6 +637,33 @@ def _ht_2d(
 		
 		good_idxs[group_idx] = True
 		boot_corr[group_idx, 1:] = vals
+	
+	return good_idxs, boot_corr
+
+
+def _ht_2d(
+	true_corr, # list of correlations for each group
+	cells, # list of Nx2 sparse matrices
+	approx_sf,
+	covariate,
+	treatment,
+	Nc_list,
+	num_boot,
+	q,
+	_estimator_1d,
+	_estimator_cov,
+	sf_bins=None, # list of outputs of bootstrap._sf_bins
+	**kwargs):
+	
+	good_idxs, boot_corr = _bootstrap_2d_groups(
+		true_corr=true_corr,
+		cells=cells,
+		approx_sf=approx_sf,
+		num_boot=num_boot,
+		q=q,
+		_estimator_1d=_estimator_1d,
+		_estimator_cov=_estimator_cov,
+		sf_bins=sf_bins)
 
 	# Skip this gene
 	if good_idxs.sum() == 0:
@@ -364,6 +679,79 @@ def _ht_2d(
 	return vals
 
 
+def _ht_2d_batch(
+	true_corr, # (n_groups, n_pairs) array of correlations for the pairs in the batch
+	cells, # list of sparse matrices with the genes in the batch as columns
+	pair_idxs, # array of column pairs in :cells:, one for each pair in the batch
+	approx_sf, # list of dense arrays
+	covariate,
+	treatment, # list of treatment arrays, one for each pair in the batch
+	Nc_list,
+	num_boot,
+	q, # list of numbers
+	_estimator_1d,
+	_estimator_cov,
+	sf_bins=None, # list of outputs of bootstrap._sf_bins
+	**kwargs):
+	"""
+		Performs hypothesis testing for a batch of gene pairs, so that the arrays shared by all pairs are sent to a worker once.
+		
+		Pairs with the same valid groups and treatment are regressed together.
+	"""
+	
+	if kwargs.get('resample_rep', False): # The resampled replicates differ between pairs
+		
+		return [_ht_2d(
+			true_corr=true_corr[:, idx],
+			cells=[c[:, pair_idxs[idx]] for c in cells],
+			approx_sf=approx_sf,
+			covariate=covariate,
+			treatment=treatment[idx],
+			Nc_list=Nc_list,
+			num_boot=num_boot,
+			q=q,
+			_estimator_1d=_estimator_1d,
+			_estimator_cov=_estimator_cov,
+			sf_bins=sf_bins,
+			**kwargs) for idx in range(len(treatment))]
+	
+	boots = [_bootstrap_2d_groups(
+		true_corr=true_corr[:, idx],
+		cells=[c[:, pair_idxs[idx]] for c in cells],
+		approx_sf=approx_sf,
+		num_boot=num_boot,
+		q=q,
+		_estimator_1d=_estimator_1d,
+		_estimator_cov=_estimator_cov,
+		sf_bins=sf_bins) for idx in range(len(treatment))]
+	
+	# Group the pairs that share a design
+	results = [(np.nan, np.nan, np.nan)]*len(treatment)
+	designs = {}
+	for idx, (good_idxs, _) in enumerate(boots):
+		
+		# Skip this pair
+		if good_idxs.sum() == 0:
+			continue
+		
+		key = (good_idxs.tobytes(), treatment[idx].shape, treatment[idx].tobytes())
+		designs.setdefault(key, []).append(idx)
+	
+	for idxs in designs.values():
+		
+		good_idxs = boots[idxs[0]][0]
+		vals = _regress_2d_batch(
+			covariate=covariate[good_idxs, :],
+			treatment=treatment[idxs[0]][good_idxs, :],
+			boot_corr=np.stack([boots[idx][1][good_idxs, :] for idx in idxs], axis=-1),
+			Nc_list=Nc_list[good_idxs],
+			**kwargs)
+		for idx, val in zip(idxs, vals):
+			results[idx] = val
+	
+	return results
+
+
 def _regress_2d(covariate, treatment, boot_corr, Nc_list, resample_rep=False, **kwargs):
 	"""
 		Performs hypothesis testing for a single pair of genes for many bootstrap iterations.
@@ -379,7 +767,7 @@ def _regress_2d(covariate, treatment, boot_corr, Nc_list, resample_rep=False, **
 
 		print('skipped')
 
-		return [np.zeros(treatment.shape[1])*np.nan]*5
+		return [np.full(treatment.shape[1], np.nan)]*5
 	
 	if (treatment == 1).mean()==1:
 		
@@ -387,14 +775,16 @@ def _regress_2d(covariate, treatment, boot_corr, Nc_list, resample_rep=False, **
 		
 	else:
 
-		boot_corr_tilde = boot_corr - LinearRegression(n_jobs=1).fit(covariate, boot_corr, Nc_list).predict(covariate)
-		treatment_tilde = treatment - LinearRegression(n_jobs=1).fit(covariate, treatment, Nc_list).predict(covariate)
+		residual = _residual_operator(covariate, Nc_list)
+		boot_corr_tilde = residual.dot(boot_corr)
+		treatment_tilde = _residual_treatment(residual, treatment, Nc_list)
 
 		if resample_rep:
 
-			replicate_assignment = np.random.choice(num_rep, size=(num_rep, num_boot))
+			gen = np.random.Generator(np.random.PCG64(bootstrap._rep_seed))
+			replicate_assignment = gen.choice(num_rep, size=(num_rep, num_boot))
 			replicate_assignment[:, 0] = np.arange(num_rep)
-			b_iter_assignment = np.random.choice(num_boot, (num_rep, num_boot))+1
+			b_iter_assignment = gen.choice(num_boot, (num_rep, num_boot))+1
 			b_iter_assignment[:, 0] = 0
 
 			boot_corr_resampled = boot_corr_tilde[(replicate_assignment, b_iter_assignment)]
@@ -408,8 +798,56 @@ def _regress_2d(covariate, treatment, boot_corr, Nc_list, resample_rep=False, **
 			corr_coef = _cross_coef(treatment_tilde, boot_corr_tilde, Nc_list)
 
 
-	corr_asl = np.apply_along_axis(lambda x: _compute_asl(x, **kwargs), 1, corr_coef)
+	corr_asl = _compute_asl_rows(corr_coef, **kwargs)
 
 	corr_se = np.nanstd(corr_coef[:, 1:], axis=1)
 
-	return corr_coef[:, 0], corr_se, corr_asl
\ No newline at end of file
+	return corr_coef[:, 0], corr_se, corr_asl
+
+
+def _regress_2d_batch(covariate, treatment, boot_corr, Nc_list, resample_rep=False, **kwargs):
+	"""
+		Performs hypothesis testing for many gene pairs that share the same design, all at once.
+		
+		Here, :boot_corr: has the pairs stacked along the last axis. 
+		Returns the same values as calling _regress_2d on each pair without replicate resampling.
+	"""
+	
+	num_rep, num_col, num_pairs = boot_corr.shape
+	
+	# Regress every bootstrap iteration of every pair at once, the iterations are dropped per pair afterwards
+	stacked_corr = boot_corr.reshape(num_rep, -1)
+	
+	if (treatment == 1).mean()==1:
+		
+		with np.errstate(invalid='ignore'):
+			corr_coef = np.average(stacked_corr, axis=0, weights=Nc_list).reshape(1, -1)
+		
+	else:
+		
+		operator = _coef_operator(covariate, treatment, Nc_list)
+		corr_coef = operator.dot(stacked_corr)
+	
+	corr_coef = corr_coef.reshape(-1, num_col, num_pairs)
+	
+	# The bootstrap iterations that are finite in every group, for all pairs at once
+	valid_iters = np.isfinite(boot_corr).all(axis=0)
+	
+	results = []
+	for idx in range(num_pairs):
+		
+		valid_boostrap_iters = valid_iters[:, idx]
+		
+		if not valid_boostrap_iters.any():
+			
+			results.append(_regress_2d(covariate, treatment, boot_corr[:, :, idx], Nc_list, **kwargs))
+			continue
+		
+		pair_corr_coef = corr_coef[:, valid_boostrap_iters, idx]
+		
+		corr_asl = _compute_asl_rows(pair_corr_coef, **kwargs)
+		corr_se = np.std(pair_corr_coef[:, 1:], axis=1) # Only finite iterations are kept
+		
+		results.append((pair_corr_coef[:, 0], corr_se, corr_asl))
+	
+	return results
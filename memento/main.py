@@ -12,9 +12,10 @@ import scipy.stats as stats
 from scipy.sparse.csr import csr_matrix
 import sys
 from joblib import Parallel, delayed
-from functools import partial
 import itertools
 import logging
+import pickle as pkl
+import base64
 
 import memento.bootstrap as bootstrap
 import memento.estimator as estimator
@@ -64,12 +65,14 @@ def setup_memento(
 		n_obs=adata.shape[0],
 		q=adata.uns['memento']['all_q'],
 		size_factor=naive_size_factor)
-	all_m[adata.X.mean(axis=0).A1 < filter_mean_thresh] = 0 # mean filter
+	obs_mean = np.bincount(adata.X.indices, weights=adata.X.data, minlength=adata.shape[1])/adata.shape[0]
+	all_m[obs_mean < filter_mean_thresh] = 0 # mean filter
 	all_res_var = estimator._residual_variance(all_m, all_v, estimator._fit_mv_regressor(all_m, all_v))
 	
 	# Select genes for normalization
-	rv_ulim = np.quantile(all_res_var[np.isfinite(all_res_var)], trim_percent)
-	all_res_var[~np.isfinite(all_res_var)] = np.inf
+	finite = np.isfinite(all_res_var)
+	rv_ulim = np.quantile(all_res_var[finite], trim_percent)
+	all_res_var[~finite] = np.inf
 	rv_mask = all_res_var < rv_ulim
 	mask = rv_mask
 	adata.uns['memento']['least_variable_genes'] = adata.var.index[mask].tolist()
@@ -111,25 +114,32 @@ def create_groups(
 # 		if key not in key_list:
 # 			del adata.uns['memento'][key]
 			
-	# Create group labels
-	adata.obs['memento_group'] = 'sg' + label_delimiter
-	for idx, col_name in enumerate(label_columns):
-		adata.obs['memento_group'] += adata.obs[col_name].astype(str)
-		if idx != len(label_columns)-1:
-			adata.obs['memento_group'] += label_delimiter
+	# Create group labels, formatting the name of each distinct combination of labels once
+	combo_codes, combos = pd.factorize(pd.MultiIndex.from_frame(adata.obs[label_columns].astype(str)))
+	names = np.array(['sg' + label_delimiter + label_delimiter.join(combo) for combo in combos], dtype=object)
+	name_codes, groups = pd.factorize(names)
+	adata.obs['memento_group'] = pd.Categorical.from_codes(name_codes[combo_codes], categories=groups)
 	
 	# Create a dict in the uns object
 	adata.uns['memento']['label_columns'] = label_columns
 	adata.uns['memento']['label_delimiter'] = label_delimiter
-	adata.uns['memento']['groups'] = adata.obs['memento_group'].drop_duplicates().tolist()
+	adata.uns['memento']['groups'] = groups.tolist()
+	
+	# Keep the labels of each group, so that they never have to be parsed back out of the group names
+	first_combo = np.unique(name_codes, return_index=True)[1]
+	adata.uns['memento']['group_labels'] = np.array([list(combos[idx]) for idx in first_combo], dtype=str).reshape(len(groups), len(label_columns))
 	adata.uns['memento']['q'] = adata.obs[adata.uns['memento']['q_column']].values
 	
-	# Create slices of the data based on the group
-	adata.uns['memento']['group_cells'] = {group:util._select_cells(adata, group) for group in adata.uns['memento']['groups']}
+	# Create slices of the data based on the group, taking each group's rows straight from the CSR matrix
+	order, bounds = util._group_order(adata)
+	X = adata.X.tocsr()
+	adata.uns['memento']['group_cells'] = {group:X[order[bounds[idx]:bounds[idx+1]]].tocsc() \
+		for idx, group in enumerate(adata.uns['memento']['groups'])}
 	
 	# For each slice, get mean q
-	adata.uns['memento']['group_q'] = {group:adata.uns['memento']['q'][(adata.obs['memento_group'] == group).values].mean() \
-		for group in adata.uns['memento']['groups']}
+	sorted_q = adata.uns['memento']['q'][order]
+	adata.uns['memento']['group_q'] = {group:sorted_q[bounds[idx]:bounds[idx+1]].mean() \
+		for idx, group in enumerate(adata.uns['memento']['groups'])}
 	
 	if not inplace:
 		return adata
@@ -147,21 +157,42 @@ def _bin_size_factor(adata):
 	approx_sf[size_factor == max_sf] = max_sf
 
 	adata.uns['memento']['all_approx_size_factor'] = approx_sf
+	
+	order, bounds = util._group_order(adata)
+	sorted_approx_sf, sorted_sf = approx_sf[order], size_factor[order]
 	adata.uns['memento']['approx_size_factor'] = \
-		{group:approx_sf[(adata.obs['memento_group'] == group).values] for group in adata.uns['memento']['groups']}
+		{group:sorted_approx_sf[bounds[idx]:bounds[idx+1]] for idx, group in enumerate(adata.uns['memento']['groups'])}
 	adata.uns['memento']['size_factor'] = \
-		{group:size_factor[(adata.obs['memento_group'] == group).values] for group in adata.uns['memento']['groups']}
+		{group:sorted_sf[bounds[idx]:bounds[idx+1]] for idx, group in enumerate(adata.uns['memento']['groups'])}
+	_store_sf_bins(adata)
+
+
+def _store_sf_bins(adata):
+	"""
+		Store the distinct binned size factors of each group, the bin of each cell and the cell count of each bin, which the bootstraps of every gene share.
+	"""
+	sf_bins = {group:bootstrap._sf_bins(adata.uns['memento']['approx_size_factor'][group]) for group in adata.uns['memento']['groups']}
+	adata.uns['memento']['sf_bin_values'] = {group:sf_bins[group][0] for group in adata.uns['memento']['groups']}
+	adata.uns['memento']['sf_bin_codes'] = {group:sf_bins[group][1] for group in adata.uns['memento']['groups']}
+	adata.uns['memento']['sf_bin_counts'] = {group:sf_bins[group][2] for group in adata.uns['memento']['groups']}
+
+
+def _get_sf_bins(adata):
+	"""
+		Returns the size factor bins of each group as a list of outputs of bootstrap._sf_bins.
+	"""
+	if 'sf_bin_counts' not in adata.uns['memento'].keys(): # Objects binned before the bins were stored
+		_store_sf_bins(adata)
+	
+	return [(
+		adata.uns['memento']['sf_bin_values'][group], 
+		adata.uns['memento']['sf_bin_codes'][group], 
+		adata.uns['memento']['sf_bin_counts'][group]) for group in adata.uns['memento']['groups']]
 	
 
 def get_groups(adata):
 	
-	df_list = []
-	
-	for group in adata.uns['memento']['groups']:
-		
-		elements = group.split(adata.uns['memento']['label_delimiter'])[1:]
-		df_list.append(elements)
-	df = pd.DataFrame(df_list, index=adata.uns['memento']['groups'], columns=adata.uns['memento']['label_columns'])
+	df = pd.DataFrame(util._group_labels(adata), index=adata.uns['memento']['groups'], columns=adata.uns['memento']['label_columns'])
 	
 	for col in df.columns:
 		df[col] = pd.to_numeric(df[col], errors='ignore')
@@ -186,29 +217,48 @@ def compute_1d_moments(
 	if 'size_factor' not in adata.uns['memento'].keys():
 		_bin_size_factor(adata)
 	
-	# Compute 1d moments for all groups
-	adata.uns['memento']['1d_moments'] = {group:estimator._get_estimator_1d(adata.uns['memento']['estimator_type'])(
-		data=adata.uns['memento']['group_cells'][group],
-		n_obs=adata.uns['memento']['group_cells'][group].shape[0],
-		q=adata.uns['memento']['group_q'][group],
-		size_factor=adata.uns['memento']['size_factor'][group]) for group in adata.uns['memento']['groups']}
+	groups = adata.uns['memento']['groups']
+	
+	# Compute 1d moments for all groups, stacked into (n_groups, n_genes) arrays
+	if adata.uns['memento']['estimator_type'] == 'hyper_relative':
+		
+		# Single pass over the nonzero entries for all groups
+		all_mean, all_var = estimator._hyper_1d_relative_batched(
+			data=adata.X,
+			group_codes=util._group_codes(adata),
+			n_obs=np.array([adata.uns['memento']['group_cells'][group].shape[0] for group in groups]),
+			q=np.array([adata.uns['memento']['group_q'][group] for group in groups]),
+			size_factor=adata.obs['memento_size_factor'].values)
+	
+	else:
+		
+		moments = [estimator._get_estimator_1d(adata.uns['memento']['estimator_type'])(
+			data=adata.uns['memento']['group_cells'][group],
+			n_obs=adata.uns['memento']['group_cells'][group].shape[0],
+			q=adata.uns['memento']['group_q'][group],
+			size_factor=adata.uns['memento']['size_factor'][group]) for group in groups]
+		all_mean = np.vstack([moment[0] for moment in moments])
+		all_var = np.vstack([moment[1] for moment in moments])
 	
 	# Create gene masks for each group
 	adata.uns['memento']['gene_filter'] = {}
 	adata.uns['memento']['gene_rv_filter'] = {}
-	for group in adata.uns['memento']['groups']:
-
-		obs_mean = adata.uns['memento']['group_cells'][group].mean(axis=0).A1
+	for idx, group in enumerate(groups):
+		
+		# The group slices are CSC, so their transposes are CSR with one row per gene
+		group_cells = adata.uns['memento']['group_cells'][group]
+		obs_mean = estimator._row_sums(group_cells.T)/group_cells.shape[0]
 		expr_filter = (obs_mean > adata.uns['memento']['filter_mean_thresh'])
-		expr_filter &= (adata.uns['memento']['1d_moments'][group][1] > 0)
+		expr_filter &= (all_var[idx] > 0)
 		adata.uns['memento']['gene_filter'][group] = expr_filter
 
-		obs_max = adata.uns['memento']['group_cells'][group].max(axis=0).todense().A1
-		adata.uns['memento']['gene_rv_filter'][group] = (obs_max >= 2)
+		# Genes with a stored value of at least 2
+		gene_of_value = np.repeat(np.arange(group_cells.shape[1]), np.diff(group_cells.indptr))
+		adata.uns['memento']['gene_rv_filter'][group] = np.bincount(gene_of_value[group_cells.data >= 2], minlength=group_cells.shape[1]) > 0
 
 	# Create overall gene mask
-	gene_masks = np.vstack([adata.uns['memento']['gene_filter'][group] for group in adata.uns['memento']['groups']])
-	gene_filter_rate = gene_masks.mean(axis=0)
+	gene_masks = np.vstack([adata.uns['memento']['gene_filter'][group] for group in groups])
+	gene_filter_rate = np.count_nonzero(gene_masks, axis=0)/gene_masks.shape[0]
 	overall_gene_mask = (gene_filter_rate > min_perc_group)
 		
 	# Do the filtering
@@ -218,41 +268,22 @@ def compute_1d_moments(
 	# Filter the genes from the data matrices as well as the 1D moments
 	if filter_genes:
 		adata.uns['memento']['group_cells'] = \
-			{group:adata.uns['memento']['group_cells'][group][:, overall_gene_mask] for group in adata.uns['memento']['groups']}
+			{group:adata.uns['memento']['group_cells'][group][:, overall_gene_mask] for group in groups}
 		
-		adata.uns['memento']['1d_moments'] = \
-			{group:[
-				adata.uns['memento']['1d_moments'][group][0][overall_gene_mask],
-				adata.uns['memento']['1d_moments'][group][1][overall_gene_mask]
-				] for group in (adata.uns['memento']['groups'])}
-		adata.uns['memento']['gene_rv_filter'] = {group:adata.uns['memento']['gene_rv_filter'][group][overall_gene_mask] for group in adata.uns['memento']['groups']}
+		all_mean, all_var = all_mean[:, overall_gene_mask], all_var[:, overall_gene_mask]
+		adata.uns['memento']['gene_rv_filter'] = {group:adata.uns['memento']['gene_rv_filter'][group][overall_gene_mask] for group in groups}
 		adata._inplace_subset_var(overall_gene_mask)
 	
 	# Estimate the residual variance transformer for all cells
-	mean_list = []
-	var_list = []
-	for group in adata.uns['memento']['groups']:
-		mean_list.append(adata.uns['memento']['1d_moments'][group][0][adata.uns['memento']['gene_rv_filter'][group]])
-		var_list.append(adata.uns['memento']['1d_moments'][group][1][adata.uns['memento']['gene_rv_filter'][group]])
-	mean_concat = np.concatenate(mean_list)
-	var_concat = np.concatenate(var_list)
-	adata.uns['memento']['mv_regressor'] = {'all':estimator._fit_mv_regressor(mean_concat, var_concat)}
+	rv_filter = np.vstack([adata.uns['memento']['gene_rv_filter'][group] for group in groups])
+	adata.uns['memento']['mv_regressor'] = {'all':estimator._fit_mv_regressor(all_mean[rv_filter], all_var[rv_filter])}
 	
-	# Estimate the residual variance transformer for each group
-	for group in adata.uns['memento']['groups']:
-		m = adata.uns['memento']['1d_moments'][group][0][adata.uns['memento']['gene_rv_filter'][group]]
-		v = adata.uns['memento']['1d_moments'][group][1][adata.uns['memento']['gene_rv_filter'][group]]
-		adata.uns['memento']['mv_regressor'][group] = estimator._fit_mv_regressor(mean_concat, var_concat)
+	# Every group uses the transformer fit on the pooled moments
+	for group in groups:
+		adata.uns['memento']['mv_regressor'][group] = adata.uns['memento']['mv_regressor']['all'].copy()
 	
 	# Compute the residual variance
-	for group in adata.uns['memento']['groups']:
-		
-		res_var = estimator._residual_variance(
-			adata.uns['memento']['1d_moments'][group][0],
-			adata.uns['memento']['1d_moments'][group][1],
-			adata.uns['memento']['mv_regressor'][group])
-		
-		adata.uns['memento']['1d_moments'][group].append(res_var)
+	all_res_var = estimator._residual_variance(all_mean, all_var, adata.uns['memento']['mv_regressor']['all'])
 		
 	# If a gene list is given, use that to further filter the moments
 	if gene_list is not None:
@@ -260,23 +291,22 @@ def compute_1d_moments(
 		given_gene_mask = np.in1d(adata.var.index.values, gene_list)
 
 		adata.uns['memento']['group_cells'] = \
-			{group:adata.uns['memento']['group_cells'][group][:, given_gene_mask] for group in adata.uns['memento']['groups']}
+			{group:adata.uns['memento']['group_cells'][group][:, given_gene_mask] for group in groups}
 		
-		adata.uns['memento']['1d_moments'] = \
-			{group:[
-				adata.uns['memento']['1d_moments'][group][0][given_gene_mask],
-				adata.uns['memento']['1d_moments'][group][1][given_gene_mask],
-				adata.uns['memento']['1d_moments'][group][2][given_gene_mask],
-				] for group in (adata.uns['memento']['groups'])}
+		all_mean, all_var, all_res_var = all_mean[:, given_gene_mask], all_var[:, given_gene_mask], all_res_var[:, given_gene_mask]
 		adata._inplace_subset_var(given_gene_mask)
+	
+	# Each group's moments are rows of the stacked arrays
+	adata.uns['memento']['1d_moments'] = {group:[all_mean[idx], all_var[idx], all_res_var[idx]] for idx, group in enumerate(groups)}
 			
 	if not inplace:
 		return adata
 	
 
-def get_corr_matrix(adata, group):
+def get_corr_matrix(adata, group, gene_list_1=None, gene_list_2=None):
 	"""
 		Computes the all by all correlation matrix for a specific group defined in memento.
+		If :gene_list_1: and :gene_list_2: are given, only the block of correlations between those genes is computed.
 	"""
 	
 	corr_matrix = estimator._hyper_corr_symmetric(
@@ -285,8 +315,8 @@ def get_corr_matrix(adata, group):
 		size_factor=adata.uns['memento']['size_factor'][group], 
 		q=adata.uns['memento']['group_q'][group], 
 		var=adata.uns['memento']['1d_moments'][group][1], 
-		idx1=None, 
-		idx2=None)
+		idx1=None if gene_list_1 is None else util._get_gene_idx(adata, gene_list_1), 
+		idx2=None if gene_list_2 is None else util._get_gene_idx(adata, gene_list_2))
 		
 	return corr_matrix
 	
@@ -306,33 +336,30 @@ def compute_2d_moments(adata, gene_pairs, inplace=True):
 	adata.uns['memento']['2d_moments'] = {}
 	adata.uns['memento']['2d_moments']['gene_pairs'] = gene_pairs
 	
-	# Get gene idxs
-	n_pairs = len(gene_pairs)
-	mapping = dict(zip(adata.var.index.values, np.arange(adata.var.shape[0])))
-	adata.uns['memento']['2d_moments']['gene_idx_1'] = np.zeros(n_pairs, dtype=int)
-	adata.uns['memento']['2d_moments']['gene_idx_2'] = np.zeros(n_pairs, dtype=int)
-	pair_idx = 0
-	for gene_1, gene_2 in gene_pairs:
-		adata.uns['memento']['2d_moments']['gene_idx_1'][pair_idx] = mapping[gene_1]
-		adata.uns['memento']['2d_moments']['gene_idx_2'][pair_idx] = mapping[gene_2]
-		pair_idx += 1
-		
-	for group in adata.uns['memento']['groups']:
-		
-		cov = estimator._get_estimator_cov(adata.uns['memento']['estimator_type'])(
-			data=adata.uns['memento']['group_cells'][group], 
-			n_obs=adata.uns['memento']['group_cells'][group].shape[0], 
-			q=adata.uns['memento']['group_q'][group],
-			size_factor=adata.uns['memento']['size_factor'][group], 
-			idx1=adata.uns['memento']['2d_moments']['gene_idx_1'], 
-			idx2=adata.uns['memento']['2d_moments']['gene_idx_2'])
+	# Get gene idxs, a duplicated gene name maps to its last column
+	adata.uns['memento']['2d_moments']['gene_idx_1'] = util._get_gene_idx(adata, [gene_1 for gene_1, _ in gene_pairs], keep='last').astype(int)
+	adata.uns['memento']['2d_moments']['gene_idx_2'] = util._get_gene_idx(adata, [gene_2 for _, gene_2 in gene_pairs], keep='last').astype(int)
 		
-		var_1 = adata.uns['memento']['1d_moments'][group][1][adata.uns['memento']['2d_moments']['gene_idx_1']]
-		var_2 = adata.uns['memento']['1d_moments'][group][1][adata.uns['memento']['2d_moments']['gene_idx_2']]
-		
-		corr = estimator._corr_from_cov(cov, var_1, var_2)
-		
-		adata.uns['memento']['2d_moments'][group] = {'cov':cov, 'corr':corr, 'var_1':var_1, 'var_2':var_2}
+	groups = adata.uns['memento']['groups']
+	
+	# Stack the covariances and variances of all groups into (n_groups, n_pairs) arrays
+	all_cov = np.vstack([estimator._get_estimator_cov(adata.uns['memento']['estimator_type'])(
+		data=adata.uns['memento']['group_cells'][group], 
+		n_obs=adata.uns['memento']['group_cells'][group].shape[0], 
+		q=adata.uns['memento']['group_q'][group],
+		size_factor=adata.uns['memento']['size_factor'][group], 
+		idx1=adata.uns['memento']['2d_moments']['gene_idx_1'], 
+		idx2=adata.uns['memento']['2d_moments']['gene_idx_2']) for group in groups]).reshape(len(groups), -1)
+	
+	all_var = np.vstack([adata.uns['memento']['1d_moments'][group][1] for group in groups])
+	all_var_1 = all_var[:, adata.uns['memento']['2d_moments']['gene_idx_1']]
+	all_var_2 = all_var[:, adata.uns['memento']['2d_moments']['gene_idx_2']]
+	
+	# Convert to correlations for all groups at once
+	all_corr = estimator._corr_from_cov(all_cov, all_var_1, all_var_2)
+	
+	for idx, group in enumerate(groups):
+		adata.uns['memento']['2d_moments'][group] = {'cov':all_cov[idx], 'corr':all_corr[idx], 'var_1':all_var_1[idx], 'var_2':all_var_2[idx]}
 
 	if not inplace:
 		return adata
@@ -373,28 +400,34 @@ def ht_1d_moments(
 			num_tests += len(v)
 	
 	# Initialize empty arrays to hold fitted coefficients and achieved significance level
-	mean_coef, mean_se, mean_asl, var_coef, var_se, var_asl = [np.zeros(num_tests)*np.nan for i in range(6)]
+	mean_coef, mean_se, mean_asl, var_coef, var_se, var_asl = [np.full(num_tests, np.nan) for i in range(6)]
 	
-	ht_funcs = []
-	for idx in range(G):
-		
-		ht_funcs.append(
-			partial(
-				hypothesis_test._ht_1d,
-				true_mean=[adata.uns['memento']['1d_moments'][group][0][idx] for group in adata.uns['memento']['groups']],
-				true_res_var=[adata.uns['memento']['1d_moments'][group][2][idx] for group in adata.uns['memento']['groups']],
-				cells=[adata.uns['memento']['group_cells'][group][:, idx] for group in adata.uns['memento']['groups']],
-				approx_sf=[adata.uns['memento']['approx_size_factor'][group] for group in adata.uns['memento']['groups']],
-				covariate=covariate.values,
-				treatment=treatment.values if treatment_for_gene is None else treatment[treatment_for_gene[adata.var.index[idx]]].values,
-				Nc_list=Nc_list,
-				num_boot=num_boot,
-				mv_fit=[adata.uns['memento']['mv_regressor'][group] for group in adata.uns['memento']['groups']],
-				q=[adata.uns['memento']['group_q'][group] for group in adata.uns['memento']['groups']],
-				_estimator_1d=estimator._get_estimator_1d(adata.uns['memento']['estimator_type']),
-				**kwargs))
-
-	results = Parallel(n_jobs=num_cpus, verbose=verbose)(delayed(func)() for func in ht_funcs)
+	# Batch the genes so that the arrays shared by every gene are sent to each worker once
+	groups = adata.uns['memento']['groups']
+	if treatment_for_gene is None:
+		gene_treatment = [treatment.values]*G
+	else:
+		gene_treatment = util._treatment_arrays(treatment, [treatment_for_gene[gene] for gene in adata.var.index])
+	batches = util._get_batches(G, num_cpus)
+	sf_bins = _get_sf_bins(adata)
+	all_mean = np.vstack([adata.uns['memento']['1d_moments'][group][0] for group in groups])
+	all_res_var = np.vstack([adata.uns['memento']['1d_moments'][group][2] for group in groups])
+	results = Parallel(n_jobs=num_cpus, verbose=verbose)(
+		delayed(hypothesis_test._ht_1d_batch)(
+			true_mean=all_mean[:, batch],
+			true_res_var=all_res_var[:, batch],
+			cells=[adata.uns['memento']['group_cells'][group][:, batch] for group in groups],
+			approx_sf=[adata.uns['memento']['approx_size_factor'][group] for group in groups],
+			covariate=covariate.values,
+			treatment=[gene_treatment[idx] for idx in batch],
+			Nc_list=Nc_list,
+			num_boot=num_boot,
+			mv_fit=[adata.uns['memento']['mv_regressor'][group] for group in groups],
+			q=[adata.uns['memento']['group_q'][group] for group in groups],
+			_estimator_1d=estimator._get_estimator_1d(adata.uns['memento']['estimator_type']),
+			sf_bins=sf_bins,
+			**kwargs) for batch in batches)
+	results = list(itertools.chain.from_iterable(results))
 	
 	ci = 0
 	for output_idx, output in enumerate(results): #ouptut_idx refers to the index of the gene, output refers to the output from the parallel
@@ -457,56 +490,58 @@ def ht_2d_moments(
 	gene_idx_2 = adata.uns['memento']['2d_moments']['gene_idx_2']
 		
 	# Initialize empty arrays to hold fitted coefficients and achieved significance level
-	corr_coef, corr_se, corr_asl = [np.zeros(gene_idx_1.shape[0])*np.nan for i in range(3)]
-		
-	# Create partial functions
-	ht_funcs = []
-	idx_list = []
-	idx_mapping = {}
-	
-	for conv_idx in range(gene_idx_1.shape[0]):
+	corr_coef, corr_se, corr_asl = [np.full(gene_idx_1.shape[0], np.nan) for i in range(3)]
 		
-		idx_1 = gene_idx_1[conv_idx]
-		idx_2 = gene_idx_2[conv_idx]
-		idx_set = frozenset({idx_1, idx_2})
-	
-		if idx_1 == idx_2: # Skip if its the same gene
-			continue
-			
-		if idx_set in idx_mapping: # Skip if this pair of gene was already calculated
-			idx_mapping[idx_set].append(conv_idx)
-			continue
-			
-		# Save the indices
-		idx_list.append((idx_1, idx_2))
-		idx_mapping[idx_set] = [conv_idx]
-		
-		# Create the partial function
-		ht_funcs.append(
-			partial(
-				hypothesis_test._ht_2d,
-				true_corr=[adata.uns['memento']['2d_moments'][group]['corr'][conv_idx] for group in adata.uns['memento']['groups']],
-				cells=[adata.uns['memento']['group_cells'][group][:, [idx_1, idx_2]] for group in adata.uns['memento']['groups']],
-				approx_sf=[adata.uns['memento']['approx_size_factor'][group] for group in adata.uns['memento']['groups']],
-				covariate=covariate.values,
-				treatment=treatment.values if treatment_for_gene is None else treatment[treatment_for_gene[frozenset({adata.var.index[idx_1],adata.var.index[idx_1]})]].values,
-				Nc_list=Nc_list,
-				num_boot=num_boot,
-				q=[adata.uns['memento']['group_q'][group] for group in adata.uns['memento']['groups']],
-				_estimator_1d=estimator._get_estimator_1d(adata.uns['memento']['estimator_type']),
-				_estimator_cov=estimator._get_estimator_cov(adata.uns['memento']['estimator_type']),
-				**kwargs))
+	# Find the unique pairs to test in the order they first appear, skipping pairs of the same gene
+	conv_pairs = np.stack([gene_idx_1, gene_idx_2], axis=1).astype(int)
+	tested = np.flatnonzero(gene_idx_1 != gene_idx_2)
+	_, first, pair_of_test = np.unique(np.sort(conv_pairs[tested], axis=1), axis=0, return_index=True, return_inverse=True)
+	first_order = np.argsort(first)
+	pair_rank = np.empty_like(first_order)
+	pair_rank[first_order] = np.arange(first_order.shape[0])
+	pair_of_test = pair_rank[pair_of_test.reshape(-1)]
+	
+	# Each pair keeps the orientation of its first appearance
+	first_conv_idx = tested[first[first_order]]
+	pair_array = conv_pairs[first_conv_idx]
+	
+	# Batch the pairs tile by tile over the pair grid, so that the arrays shared by every pair are sent to each worker once
+	# and each batch only carries the columns of a few genes
+	groups = adata.uns['memento']['groups']
+	if treatment_for_gene is None:
+		pair_treatment = [treatment.values]*pair_array.shape[0]
+	else:
+		pair_treatment = util._treatment_arrays(treatment, [treatment_for_gene[frozenset({adata.var.index[idx_1],adata.var.index[idx_1]})] for idx_1, idx_2 in pair_array])
+	pair_order = util._tile_order(pair_array)
+	batches = [pair_order[batch] for batch in util._get_batches(pair_array.shape[0], num_cpus)]
+	sf_bins = _get_sf_bins(adata)
+	batch_genes = [np.unique(pair_array[batch]) for batch in batches]
+	all_corr = np.vstack([adata.uns['memento']['2d_moments'][group]['corr'] for group in groups])[:, first_conv_idx]
 	
 	# Parallel processing
-	results = Parallel(n_jobs=num_cpus, verbose=verbose)(delayed(func)() for func in ht_funcs)
-	
-	for output_idx in range(len(results)):
-		
-		idx_1, idx_2 = idx_list[output_idx]
-		
-		# Fill in the value for every element that should have the same value
-		for conv_idx in idx_mapping[frozenset({idx_1, idx_2})]:
-			corr_coef[conv_idx], corr_se[conv_idx], corr_asl[conv_idx] = results[output_idx]
+	results = Parallel(n_jobs=num_cpus, verbose=verbose)(
+		delayed(hypothesis_test._ht_2d_batch)(
+			true_corr=all_corr[:, batch],
+			cells=[adata.uns['memento']['group_cells'][group][:, genes] for group in groups],
+			pair_idxs=np.searchsorted(genes, pair_array[batch]),
+			approx_sf=[adata.uns['memento']['approx_size_factor'][group] for group in groups],
+			covariate=covariate.values,
+			treatment=[pair_treatment[pair_idx] for pair_idx in batch],
+			Nc_list=Nc_list,
+			num_boot=num_boot,
+			q=[adata.uns['memento']['group_q'][group] for group in groups],
+			_estimator_1d=estimator._get_estimator_1d(adata.uns['memento']['estimator_type']),
+			_estimator_cov=estimator._get_estimator_cov(adata.uns['memento']['estimator_type']),
+			sf_bins=sf_bins,
+			**kwargs) for batch, genes in zip(batches, batch_genes))
+	results = list(itertools.chain.from_iterable(results))
+	
+	pair_result = np.full((pair_array.shape[0], 3), np.nan)
+	for pair_idx, result in zip(itertools.chain.from_iterable(batches), results):
+		pair_result[pair_idx] = np.ravel(result)
+	
+	# Fill in the value for every element that should have the same value
+	corr_coef[tested], corr_se[tested], corr_asl[tested] = pair_result[pair_of_test].T
 			
 	# Save the hypothesis test result
 	adata.uns['memento']['2d_ht'] = {}
@@ -526,17 +561,17 @@ def get_1d_moments(adata, groupby=None):
 		If groupby is used, take the mean of the moments weighted by cell counts
 	"""
 	
-	moment_mean_df = pd.DataFrame()
-	moment_mean_df['gene'] = adata.var.index.tolist()
-	moment_var_df = pd.DataFrame()
-	moment_var_df['gene'] = adata.var.index.tolist()
-	
+	# Stack the moments of all groups and take the logs once
 	cell_counts = {k:v.shape[0] for k,v in adata.uns['memento']['group_cells'].items()}
-	for group, val in adata.uns['memento']['1d_moments'].items():
-		if group == 'all':
-			continue
-		moment_mean_df[group] = np.log(val[0])
-		moment_var_df[group] = np.log(val[2])
+	groups = [group for group in adata.uns['memento']['1d_moments'].keys() if group != 'all']
+	mean = np.vstack([adata.uns['memento']['1d_moments'][group][0] for group in groups])
+	res_var = np.vstack([adata.uns['memento']['1d_moments'][group][2] for group in groups])
+	with np.errstate(divide='ignore', invalid='ignore'):
+		log_mean = np.log(mean)
+		log_res_var = np.log(res_var)
+	
+	moment_mean_df = pd.DataFrame({'gene':adata.var.index.tolist(), **dict(zip(groups, log_mean))})
+	moment_var_df = pd.DataFrame({'gene':adata.var.index.tolist(), **dict(zip(groups, log_res_var))})
 	
 	if groupby is None:
 		return moment_mean_df, moment_var_df, cell_counts
@@ -545,39 +580,21 @@ def get_1d_moments(adata, groupby=None):
 		unique_groupby = adata.obs[groupby].astype(str).drop_duplicates().values
 	else:
 		unique_groupby = ['sg']
-	groupby_mean = {k:0 for k in unique_groupby}
-	groupby_var = {k:0 for k in unique_groupby}
-	groupby_mean_count = {k:0 for k in unique_groupby}
-	groupby_var_count = {k:0 for k in unique_groupby}
-	
 	groupby_mean_df = pd.DataFrame()
 	groupby_mean_df['gene'] = adata.var.index.tolist()
 	groupby_var_df = pd.DataFrame()
 	groupby_var_df['gene'] = adata.var.index.tolist()
-
+	
+	counts = np.array([cell_counts[group] for group in groups]).reshape(-1, 1)
+	m = np.where(np.isnan(log_mean), 0, log_mean)
+	v = np.where(np.isnan(log_res_var), 0, log_res_var)
+	
 	for key in unique_groupby:
-		for group, val in adata.uns['memento']['1d_moments'].items():
-			if group == 'all':
-				continue
-				
-			if key in group: # stringfied
-				
-				m = np.log(val[0])
-				v = np.log(val[2])
-				m[np.isnan(m)] = 0
-				v[np.isnan(v)] = 0
-				
-				groupby_mean[key] += m*cell_counts[group]
-				groupby_mean_count[key] += (val[0] > 0)*cell_counts[group]
-
-				groupby_var[key] += v*cell_counts[group]
-				groupby_var_count[key] += (val[2] > 0)*cell_counts[group]
-
-		groupby_mean[key] /= groupby_mean_count[key]
-		groupby_var[key] /= groupby_var_count[key]
-	
-		groupby_mean_df[groupby + '_' + key] = groupby_mean[key]
-		groupby_var_df[groupby + '_' + key] = groupby_var[key]
+		
+		key_groups = util._groups_with_label(adata, groups, groupby, key)
+		
+		groupby_mean_df[groupby + '_' + key] = (m[key_groups]*counts[key_groups]).sum(axis=0)/((mean[key_groups] > 0)*counts[key_groups]).sum(axis=0)
+		groupby_var_df[groupby + '_' + key] = (v[key_groups]*counts[key_groups]).sum(axis=0)/((res_var[key_groups] > 0)*counts[key_groups]).sum(axis=0)
 	
 	return groupby_mean_df.copy(), groupby_var_df.copy()
 
@@ -605,29 +622,23 @@ def get_2d_moments(adata, groupby=None):
 		unique_groupby = adata.obs[groupby].astype(str).drop_duplicates().values
 	else:
 		unique_groupby = ['sg']
-	groupby_corr = {k:0 for k in unique_groupby}
-	groupby_corr_count = {k:0 for k in unique_groupby}
-	
 	groupby_corr_df = pd.DataFrame()
 	groupby_corr_df['gene_1'] = moment_corr_df['gene_1']
 	groupby_corr_df['gene_2'] = moment_corr_df['gene_2']
 	
+	# Stack the correlations of all groups
+	groups = [group for group in adata.uns['memento']['2d_moments'].keys() if 'sg^' in group]
+	counts = np.array([cell_counts[group] for group in groups]).reshape(-1, 1)
+	corr = np.vstack([adata.uns['memento']['2d_moments'][group]['corr'] for group in groups])
+	
+	valid = ~np.isnan(corr)
+	c = np.where(valid, corr, 0)
+	
 	for key in unique_groupby:
-		for group, val in adata.uns['memento']['2d_moments'].items():
-			if 'sg^' not in group:
-				continue
-				
-			if key in group: #stringfied
-				
-				c = val['corr']
-				valid = ~np.isnan(c)
-				c[np.isnan(c)] = 0
-				
-				groupby_corr[key] += c*cell_counts[group]
-				groupby_corr_count[key] += valid*cell_counts[group]
-
-		groupby_corr[key] /= groupby_corr_count[key]
-		groupby_corr_df[groupby + '_' + key] = groupby_corr[key]
+		
+		key_groups = util._groups_with_label(adata, groups, groupby, key)
+		
+		groupby_corr_df[groupby + '_' + key] = (c[key_groups]*counts[key_groups]).sum(axis=0)/(valid[key_groups]*counts[key_groups]).sum(axis=0)
 		
 	return groupby_corr_df.copy()
 
@@ -639,10 +650,13 @@ def get_1d_ht_result(adata):
 	
 	
 	if 'treatment_for_gene' in adata.uns['memento']['1d_ht']:
-		result_df = pd.concat([
-			pd.DataFrame(
-				itertools.product([g], adata.uns['memento']['1d_ht']['treatment_for_gene'][g]), 
-				columns=['gene', 'tx']) for g in adata.var.index])
+		
+		# Each gene's rows are indexed from 0, as when the per-gene frames were concatenated
+		gene_tx = [adata.uns['memento']['1d_ht']['treatment_for_gene'][g] for g in adata.var.index]
+		num_tx = np.array([len(tx) for tx in gene_tx], dtype=int)
+		result_df = pd.DataFrame(
+			{'gene':np.repeat(adata.var.index.values, num_tx), 'tx':list(itertools.chain.from_iterable(gene_tx))},
+			index=np.arange(num_tx.sum()) - np.repeat(np.cumsum(num_tx) - num_tx, num_tx))
 	else:
 		result_df = pd.DataFrame(itertools.product(adata.var.index, adata.uns['memento']['1d_ht']['treatment'].columns), columns=['gene', 'tx'])
 	result_df['de_coef'] = adata.uns['memento']['1d_ht']['mean_coef']
@@ -673,11 +687,12 @@ def get_2d_ht_result(adata):
 def prepare_to_save(adata, keep=False):
 	"""
 		pickle all objects that aren't compatible with scanpy write
+		
+		With :keep:, all mean-variance regressors are pickled together into one base64 string,
+		which can be restored with pkl.loads(base64.b64decode(adata.uns['memento']['mv_regressor'])).
 	"""
 	
-	for group in adata.uns['memento']['groups'] + ['all']:
-		
-		if not keep:
-			del adata.uns['memento']['mv_regressor'][group]
-		else:
-			adata.uns['memento']['mv_regressor'][group] = str(pkl.dumps(adata.uns['memento']['mv_regressor'][group]))
\ No newline at end of file
+	if not keep:
+		adata.uns['memento']['mv_regressor'] = {}
+	else:
+		adata.uns['memento']['mv_regressor'] = base64.b64encode(pkl.dumps(adata.uns['memento']['mv_regressor'])).decode('ascii')
\ No newline at end of file
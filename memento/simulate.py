@@ -24,7 +24,7 @@ def extract_parameters(data, q=0.1, min_mean=0.001):
 	
 	good_idx = np.where(data.mean(axis=0).A1 > min_mean)[0]
 	
-	Nc = data.sum(axis=1).A1/q
+	Nc = estimator._row_sums(data)/q
 	
 	z_mean = x_mean*Nc.mean()
 	z_var = (x_var + x_mean**2)*(Nc**2).mean() - x_mean**2*Nc.mean()**2
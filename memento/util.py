@@ -1,5 +1,7 @@
 import scipy.stats as stats
 import numpy as np
+import pandas as pd
+from joblib import effective_n_jobs
 import time
 import itertools
 import scipy as sp
@@ -8,15 +10,113 @@ from statsmodels.stats.multitest import fdrcorrection
 def _select_cells(adata, group):
 	""" Slice the data horizontally. """
 
-	cell_selector = (adata.obs['memento_group'] == group).values
+	order, bounds = _group_order(adata)
+	group_idx = list(adata.uns['memento']['groups']).index(group)
 	
-	return adata.X[cell_selector, :].tocsc()
+	return adata.X[order[bounds[group_idx]:bounds[group_idx+1]], :].tocsc()
 
 
-def _get_gene_idx(adata, gene_list):
-	""" Returns the indices of each gene in the list. """
+def _group_codes(adata):
+	""" Returns the index of each cell's group in :adata.uns['memento']['groups']:. """
+	
+	labels = adata.obs['memento_group']
+	if isinstance(labels.dtype, pd.CategoricalDtype) and labels.cat.categories.tolist() == list(adata.uns['memento']['groups']):
+		return labels.cat.codes.values
+	
+	return pd.Categorical(labels.values, categories=adata.uns['memento']['groups']).codes
+
+
+def _group_labels(adata):
+	"""
+		Returns the (n_groups, n_label_columns) array of the labels of each group in :adata.uns['memento']['groups']:.
+		
+		Objects grouped before the labels were stored fall back to splitting the group names on the label delimiter.
+	"""
+	
+	if 'group_labels' in adata.uns['memento'].keys():
+		return np.asarray(adata.uns['memento']['group_labels'])
+	
+	return np.array([group.split(adata.uns['memento']['label_delimiter'])[1:] for group in adata.uns['memento']['groups']])
 
-	return np.array([np.where(adata.var.index == gene)[0][0] for gene in gene_list]) # maybe use np.isin
+
+def _groups_with_label(adata, groups, groupby, key):
+	"""
+		Returns a mask of the :groups: whose label in the :groupby: column is exactly :key:.
+		Falls back to matching :key: anywhere in the group name when :groupby: is not one of the label columns.
+	"""
+	
+	label_columns = list(adata.uns['memento']['label_columns'])
+	if groupby not in label_columns:
+		return np.array([key in group for group in groups]) # stringfied
+	
+	labels = _group_labels(adata)[:, label_columns.index(groupby)]
+	group_position = {group:idx for idx, group in enumerate(adata.uns['memento']['groups'])}
+	return np.array([labels[group_position[group]] == key for group in groups])
+
+
+def _group_order(adata):
+	"""
+		Returns the cell ordering that makes each group contiguous and the group boundaries within that ordering.
+		Rows of group :adata.uns['memento']['groups'][i]: are order[bounds[i]:bounds[i+1]].
+		
+		The ordering is computed from the current group labels of :adata.obs: on every call rather than stored, 
+		so it stays correct when the cells are subset or reordered after create_groups.
+	"""
+	
+	codes = _group_codes(adata)
+	order = np.argsort(codes, kind='stable')
+	bounds = np.searchsorted(codes[order], np.arange(len(adata.uns['memento']['groups'])+1))
+	
+	return order, bounds
+
+
+def _treatment_arrays(treatment, columns_list):
+	"""
+		Returns the values of :treatment: restricted to each list of columns in :columns_list:.
+		Lists with the same columns share one array, so that it is pickled once for each batch of tests.
+	"""
+	
+	cache = {}
+	arrays = []
+	for columns in columns_list:
+		key = tuple(columns)
+		if key not in cache:
+			cache[key] = treatment[list(columns)].values
+		arrays.append(cache[key])
+	
+	return arrays
+
+
+def _get_batches(num_items, num_cpus, batches_per_cpu=4, max_batch_size=100):
+	""" Split the indices of the tests into contiguous batches, a few for each worker. """
+	
+	num_batches = min(num_items, max(batches_per_cpu*effective_n_jobs(num_cpus), int(np.ceil(num_items/max_batch_size))))
+	
+	return np.array_split(np.arange(num_items), max(num_batches, 1))
+
+
+def _tile_order(pairs, tile=64):
+	""" Orders the gene pairs block by block over the pair grid, so that contiguous batches of pairs share few genes. """
+	
+	return np.lexsort((pairs[:, 1], pairs[:, 0], pairs[:, 1]//tile, pairs[:, 0]//tile))
+
+
+def _get_gene_idx(adata, gene_list, keep='first'):
+	""" Returns the indices of each gene in the list. Duplicated gene names resolve to their :keep: ('first' or 'last') occurrence. """
+	
+	genes = adata.var.index
+	if genes.is_unique:
+		gene_idx = genes.get_indexer(gene_list)
+	else:
+		# get_indexer needs unique labels, so look the genes up among the occurrences that are kept
+		kept_idx = np.flatnonzero(~genes.duplicated(keep=keep))
+		gene_idx = genes[kept_idx].get_indexer(gene_list)
+		gene_idx = np.where(gene_idx < 0, -1, kept_idx[gene_idx])
+	
+	if (gene_idx < 0).any():
+		raise KeyError([gene for gene, idx in zip(gene_list, gene_idx) if idx < 0])
+	
+	return gene_idx
 
 
 def _fdrcorrect(pvals):